@@ -0,0 +1,8 @@
+'''
+Benchmarks for shellmacros, not part of the package
+
+Synthetic macro tables (see workloads.py) and a runner that times the
+engine on them and writes the results as JSON (see run.py):
+
+    python -m benchmarks -o results.json
+'''
@@ -0,0 +1,232 @@
+'''
+Time the engine on the synthetic workloads, see workloads.py
+
+    python -m benchmarks                          # every workload, 10k macros
+    python -m benchmarks -n 500000 -w deep_chain  # one workload, a big table
+    python -m benchmarks -o new.json --compare old.json
+
+The results are written as JSON (-o), run the same benchmarks on another
+commit and --compare the two files to find regressions.
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from shellmacros import (MacroRecursionError, MacroUndefinedError,
+                         MacroSyntaxError, MacroNonAsciiError)
+
+from .workloads import WORKLOADS, make_workload
+
+__all__ = ['OPERATIONS', 'run_benchmarks', 'compare', 'main']
+
+# The version of the JSON results
+FORMAT = 1
+
+# unresolve_text() is slow on big tables, only this many texts are used
+UNRESOLVE_TEXTS = 100
+
+# an operation that raises one of these is reported, not timed
+_ERRORS = (MacroRecursionError, MacroUndefinedError, MacroSyntaxError, MacroNonAsciiError)
+
+
+def _resolve_text(e, w):
+    for text in w.texts:
+        r = e.resolve_text(text)
+        if not r.ok:
+            raise r.error
+    return len(w.texts)
+
+
+def _resolve_text_reference(e, w):
+    e.resolver = e.RESOLVER_REFERENCE
+    return _resolve_text(e, w)
+
+
+def _unresolve_text(e, w):
+    texts = w.texts[:UNRESOLVE_TEXTS]
+    for text in texts:
+        e.unresolve_text(text)
+    return len(texts)
+
+
+def _output_order(e, w):
+    e.output_order()
+    return len(w)
+
+
+def _output_array(e, w):
+    e.output_array()
+    return len(w)
+
+
+def _make_fragment(e, w):
+    e.make_fragment_str()
+    return len(w)
+
+
+def _bash_fragment(e, w):
+    e.bash_fragment_str()
+    return len(w)
+
+
+def _json_macros(e, w):
+    e.json_macros_str()
+    return len(w)
+
+
+OPERATIONS = {
+    'resolve_text': _resolve_text,
+    'resolve_text_reference': _resolve_text_reference,
+    'unresolve_text': _unresolve_text,
+    'output_order': _output_order,
+    'output_array': _output_array,
+    'make_fragment_str': _make_fragment,
+    'bash_fragment_str': _bash_fragment,
+    'json_macros_str': _json_macros,
+}
+'''The operations timed, each is given a fresh engine and the workload
+and returns how many items (texts or macros) it did'''
+
+
+def _time_one(w, op, repeat):
+    # internal, run op on a new engine repeat times
+    times = []
+    items = 0
+    for _ in range(repeat):
+        e = w.engine()
+        start = time.perf_counter()
+        try:
+            items = OPERATIONS[op](e, w)
+        except _ERRORS as ex:
+            return {'error': '%s: %s' % (type(ex).__name__, str(ex)[:200])}
+        times.append(time.perf_counter() - start)
+    return {
+        'items': items,
+        'best': min(times),
+        'median': statistics.median(times),
+        'per_item': min(times) / max(1, items),
+    }
+
+
+def _commit():
+    # internal, the git commit being measured, if known
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here,
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('ascii').strip()
+
+
+def run_benchmarks(n=10000, workloads=None, operations=None, repeat=3, seed=1, progress=None):
+    '''
+    Time the operations on the workloads, returns the results as a dict
+
+    :param n: The number of macros in each table
+    :param workloads: Names, see workloads.WORKLOADS, None means all
+    :param operations: Names, see OPERATIONS, None means all
+    :param repeat: Times each operation is run, the best and median time are kept
+    :param progress: If given called with each result as it is made
+    '''
+    results = []
+    for name in (workloads or sorted(WORKLOADS)):
+        w = make_workload(name, n, seed)
+        for op in (operations or list(OPERATIONS)):
+            r = {'workload': name, 'operation': op, 'n': n, 'macros': len(w)}
+            r.update(_time_one(w, op, repeat))
+            results.append(r)
+            if progress is not None:
+                progress(r)
+    return {
+        'format': FORMAT,
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': repeat,
+        'seed': seed,
+        'results': results,
+    }
+
+
+def compare(old, new, threshold=0.10):
+    '''
+    Compare two results (from run_benchmarks()), returns a list of lines
+
+    Benchmarks more than threshold (a fraction) slower are marked SLOWER,
+    those faster are marked faster.
+    '''
+    def key(r):
+        return (r['workload'], r['operation'], r['n'])
+
+    before = dict((key(r), r) for r in old['results'])
+    lines = ['%-14s %-24s %8s %11s %11s %7s' % ('workload', 'operation', 'n', 'before', 'after', 'ratio')]
+    for r in new['results']:
+        was = before.get(key(r), None)
+        if (was is None) or ('best' not in was) or ('best' not in r):
+            continue
+        ratio = r['best'] / was['best']
+        mark = ''
+        if ratio > 1 + threshold:
+            mark = 'SLOWER'
+        elif ratio < 1 - threshold:
+            mark = 'faster'
+        lines.append('%-14s %-24s %8d %10.4fs %10.4fs %6.2fx %s'
+                     % (r['workload'], r['operation'], r['n'], was['best'], r['best'], ratio, mark))
+    return lines
+
+
+def _show(r):
+    # internal, print one result
+    if 'error' in r:
+        print('%-14s %-24s %8d  error: %s' % (r['workload'], r['operation'], r['n'], r['error']))
+    else:
+        print('%-14s %-24s %8d %10.4fs %10.2fus/item'
+              % (r['workload'], r['operation'], r['n'], r['best'], r['per_item'] * 1e6))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='Time shellmacros on synthetic macro tables')
+    parser.add_argument('-n', '--macros', type=int, action='append',
+                        help='macros per table, may be given more than once (default 10000)')
+    parser.add_argument('-w', '--workload', action='append', choices=sorted(WORKLOADS),
+                        help='workload to run, may be given more than once (default all)')
+    parser.add_argument('-O', '--operation', action='append', choices=list(OPERATIONS),
+                        help='operation to time, may be given more than once (default all)')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare the results with this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='slower by more than this fraction is a regression (default 0.10)')
+    args = parser.parse_args(argv)
+
+    answer = None
+    for n in (args.macros or [10000]):
+        r = run_benchmarks(n, args.workload, args.operation, args.repeat, args.seed, _show)
+        if answer is None:
+            answer = r
+        else:
+            answer['results'].extend(r['results'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(answer, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print('')
+        print('compared with %s (commit %s)' % (args.compare, old.get('commit')))
+        lines = compare(old, answer, args.threshold)
+        for line in lines:
+            print(line)
+        if any(line.endswith('SLOWER') for line in lines):
+            return 1
+    return 0
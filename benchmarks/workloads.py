@@ -0,0 +1,154 @@
+'''
+Synthetic macro tables, see run.py
+
+Each generator makes an engine with about n macros and a list of texts
+to resolve. The tables are made with a fixed random seed, the same n
+always gives the same table so runs can be compared across commits.
+'''
+import random
+
+from shellmacros import MacroEngine
+
+__all__ = ['Workload', 'WORKLOADS', 'make_workload']
+
+# resolve this many texts per workload, whatever the table size
+TEXTS = 1000
+
+# resolving replaces at most 50 macros (MAX_RECURSION), stay below that
+CHAIN_DEPTH = 40
+
+
+class Workload(object):
+    '''
+    A macro table and some texts to resolve with it
+
+    Engines are made on demand, every benchmark starts with a fresh one
+    so nothing resolved by an earlier benchmark is cached.
+    '''
+
+    def __init__(self, name, n, macros, texts, keep=(), external=()):
+        self.name = name
+        '''The generator used, see WORKLOADS'''
+        self.n = n
+        '''The size asked for'''
+        self.macros = macros
+        '''List of (name, value)'''
+        self.texts = texts
+        '''Texts for resolve_text()'''
+        self.keep = keep
+        '''List of (name, value) added with add_keep()'''
+        self.external = external
+        '''List of (name, value) added with add_external(), value may be None'''
+
+    def __len__(self):
+        return len(self.macros) + len(self.keep) + len(self.external)
+
+    def engine(self, resolver=MacroEngine.RESOLVER_COMPILED):
+        '''Return a new engine holding the macros'''
+        e = MacroEngine()
+        e.resolver = resolver
+        e.add_many(self.macros)
+        if len(self.keep):
+            e.add_many(self.keep, keep=True)
+        for name, value in self.external:
+            e.add_external(name, value)
+        return e
+
+
+def deep_chain(n, rnd):
+    '''Chains of macros each using the one before, C3_39 -> C3_38 ... -> C3_0'''
+    macros = []
+    chains = max(1, n // CHAIN_DEPTH)
+    for c in range(chains):
+        macros.append(('C%d_0' % c, '/opt/chain%d' % c))
+        for d in range(1, CHAIN_DEPTH):
+            macros.append(('C%d_%d' % (c, d), '${C%d_%d}/d%d' % (c, d - 1, d)))
+    texts = []
+    for _ in range(TEXTS):
+        c = rnd.randrange(chains)
+        texts.append('cd ${C%d_%d} && make' % (c, rnd.randrange(CHAIN_DEPTH)))
+    return Workload('deep_chain', n, macros, texts)
+
+
+def wide_fanout(n, rnd):
+    '''Many leaf macros, each text and some macros use dozens of them'''
+    leaves = max(1, n - n // 100)
+    macros = [('LEAF%d' % i, 'leafvalue%d' % i) for i in range(leaves)]
+    for i in range(n - leaves):
+        refs = ' '.join('${LEAF%d}' % rnd.randrange(leaves) for _ in range(CHAIN_DEPTH))
+        macros.append(('WIDE%d' % i, refs))
+    texts = []
+    for _ in range(TEXTS):
+        texts.append(' -I'.join('${LEAF%d}' % rnd.randrange(leaves) for _ in range(20)))
+    return Workload('wide_fanout', n, macros, texts)
+
+
+def nested_names(n, rnd):
+    '''Names made from other macros, ${${ARCH}_${BOARD}}'''
+    arches = max(1, int(n ** 0.5) // 2)
+    boards = max(1, n // (2 * arches))
+    macros = []
+    for a in range(arches):
+        for b in range(boards):
+            macros.append(('arch%d_board%d' % (a, b), '-DARCH=%d -DBOARD=%d' % (a, b)))
+    selectors = max(1, (n - len(macros)) // 2)
+    for s in range(selectors):
+        macros.append(('ARCH%d' % s, 'arch%d' % rnd.randrange(arches)))
+        macros.append(('BOARD%d' % s, 'board%d' % rnd.randrange(boards)))
+    texts = []
+    for _ in range(TEXTS):
+        s = rnd.randrange(selectors)
+        texts.append('gcc ${${ARCH%d}_${BOARD%d}} -c foo.c' % (s, s))
+    return Workload('nested_names', n, macros, texts)
+
+
+def keep_external(n, rnd):
+    '''A third keep, a third external (half without a value), the rest use them'''
+    third = max(1, n // 3)
+    keep = [('KEEP%d' % i, 'kept%d' % i) for i in range(third)]
+    external = []
+    for i in range(third):
+        external.append(('EXT%d' % i, ('/mnt/ext%d' % i) if (i % 2) else None))
+    macros = []
+    for i in range(max(1, n - 2 * third)):
+        macros.append(('USE%d' % i, '${KEEP%d}/${EXT%d}/use%d'
+                       % (rnd.randrange(third), rnd.randrange(third), i)))
+    texts = []
+    for _ in range(TEXTS):
+        texts.append('${USE%d} ${KEEP%d} ${USE%d}' % (rnd.randrange(len(macros)),
+                                                     rnd.randrange(third),
+                                                     rnd.randrange(len(macros))))
+    return Workload('keep_external', n, macros, texts, keep, external)
+
+
+def long_values(n, rnd):
+    '''Values of a few KB with references scattered through them'''
+    short = max(1, n - n // 10)
+    macros = [('S%d' % i, 'short%d' % i) for i in range(short)]
+    filler = 'x' * 200
+    for i in range(n - short):
+        pieces = ['${S%d}' % rnd.randrange(short) for _ in range(20)]
+        macros.append(('LONG%d' % i, filler.join(pieces)))
+    texts = []
+    longs = n - short
+    for _ in range(TEXTS):
+        if longs:
+            texts.append('echo ${LONG%d}' % rnd.randrange(longs))
+        else:
+            texts.append('echo ${S%d}' % rnd.randrange(short))
+    return Workload('long_values', n, macros, texts)
+
+
+WORKLOADS = {
+    'deep_chain': deep_chain,
+    'wide_fanout': wide_fanout,
+    'nested_names': nested_names,
+    'keep_external': keep_external,
+    'long_values': long_values,
+}
+'''The workload generators by name'''
+
+
+def make_workload(name, n, seed=1):
+    '''Return the named workload with about n macros'''
+    return WORKLOADS[name](n, random.Random(seed))
@@ -31,5 +31,11 @@ from .engine import MacroEngine
 from .istr import IStr
 from .entry import MacroEntry
 from .result import MacroResult
+from .emission import MacroEmission
+from .frozen import FrozenMacroEngine
+from .environment import EnvironmentSnapshot
+from .layered import ChildMacroEngine
+from .instrument import Instrumentation
+from .trace import TraceBuffer
 from .exceptions import *
 
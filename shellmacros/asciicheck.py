@@ -0,0 +1,89 @@
+'''
+Check generated output is printable ASCII, see MacroEngine.ascii_check
+
+Build scripts are generally ASCII only, not unicode. The allowed
+characters are newline and 0x20 to 0x7e (printable ascii), everything
+else is an error that names the line and column where it was found.
+
+Good text (the common case) is checked without a python loop:
+str.isascii() then bytes.translate() deleting every allowed character,
+nothing must be left. Only when something is left is the text searched
+again to find where.
+
+Text can be checked in one piece or in chunks, see AsciiChecker.
+'''
+import re
+
+from .exceptions import MacroNonAsciiError
+
+__all__ = ['AsciiChecker', 'check_ascii']
+
+# This regex matches the first NON matching value
+# \x0a = ASCII NEWLINE, ie: \n
+# \x20 = ASCII SPACE
+# \x7F = ASCII delete, we don't want that
+# Thus (0x0a) + range(0x20 to 0x7e) is good
+# the ^ at start means NOT
+_non_ascii_regex = re.compile(r'[^\n -~]')
+# bytes.translate() deletes these, anything left over is bad
+_allowed = bytes(range(0x20, 0x7f)) + b'\n'
+
+
+def _is_clean(s):
+    # internal, True if s is only newlines and printable ascii
+    return s.isascii() and not s.encode('ascii').translate(None, _allowed)
+
+
+class AsciiChecker(object):
+    '''
+    Checks text is printable ASCII, given as one or more chunks
+
+    Chunks are checked in order, line numbers and columns count from the
+    start of the first chunk. Chunks may split lines anywhere.
+    '''
+
+    def __init__(self):
+        self.lineno = 1
+        '''The line number the next chunk starts on'''
+        self.column = 1
+        '''The column the next chunk starts at'''
+        # the start of the current line, from earlier chunks (for the error)
+        self._partial = ''
+
+    def check(self, chunk):
+        '''Check the next chunk, returns the chunk or raises MacroNonAsciiError'''
+        if not _is_clean(chunk):
+            self._error(chunk, _non_ascii_regex.search(chunk).start())
+        newlines = chunk.count('\n')
+        if newlines:
+            start = chunk.rfind('\n') + 1
+            self.lineno += newlines
+            self.column = len(chunk) - start + 1
+            self._partial = chunk[start:]
+        else:
+            self.column += len(chunk)
+            self._partial += chunk
+        return chunk
+
+    def _error(self, chunk, pos):
+        # internal, the bad character is at chunk[pos]
+        start = chunk.rfind('\n', 0, pos) + 1
+        end = chunk.find('\n', pos)
+        if end < 0:
+            end = len(chunk)
+        lineno = self.lineno + chunk.count('\n', 0, pos)
+        if start == 0:
+            column = self.column + pos
+            line = self._partial + chunk[:end]
+        else:
+            column = pos - start + 1
+            line = chunk[start:end]
+        raise MacroNonAsciiError('non-ascii in output, line: %d, column: %d, text=%s'
+                                 % (lineno, column, line))
+
+
+def check_ascii(s):
+    '''Check s is printable ASCII, returns s or raises MacroNonAsciiError'''
+    if _is_clean(s):
+        return s
+    return AsciiChecker().check(s)
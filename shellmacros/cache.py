@@ -0,0 +1,107 @@
+'''
+A cache where every entry remembers which macros it depends upon
+
+When a macro changes, only the entries that depend upon that macro
+are thrown away, everything else remains valid.
+'''
+
+__all__ = ['DependencyCache']
+
+
+class DependencyCache(object):
+    '''
+    Holds key/value pairs, each with the set of macro names the value depends on
+    '''
+
+    def __init__(self):
+        self._values = dict()
+        # key -> the names this key depends on
+        self._depends = dict()
+        # name -> set of keys that depend on this name
+        self._users = dict()
+        self.invalidations = 0
+        '''How many entries have been thrown away due to a change'''
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def depends(self, key):
+        '''The names the value of key depends on'''
+        return self._depends[key]
+
+    def users(self, name):
+        '''The keys whose value depends on the macro name'''
+        return self._users.get(name, ())
+
+    def keys(self):
+        return self._values.keys()
+
+    def items(self):
+        return self._values.items()
+
+    def put(self, key, value, depends):
+        '''Add (or replace) key=value, which depends on the macro names in depends'''
+        self.discard(key)
+        self._values[key] = value
+        depends = tuple(set(depends))
+        self._depends[key] = depends
+        for name in depends:
+            users = self._users.get(name)
+            if users is None:
+                users = self._users[name] = set()
+            users.add(key)
+
+    def put_many(self, items):
+        '''Same as put() for each (key, value, depends) in items'''
+        values = self._values
+        all_depends = self._depends
+        all_users = self._users
+        for key, value, depends in items:
+            if key in values:
+                self.discard(key)
+            values[key] = value
+            depends = tuple(set(depends))
+            all_depends[key] = depends
+            for name in depends:
+                users = all_users.get(name)
+                if users is None:
+                    users = all_users[name] = set()
+                users.add(key)
+
+    def discard(self, key):
+        '''Remove this key if present'''
+        if key not in self._values:
+            return
+        del self._values[key]
+        for name in self._depends.pop(key):
+            users = self._users[name]
+            users.discard(key)
+            if not users:
+                del self._users[name]
+
+    def invalidate(self, name):
+        '''
+        The macro name has changed, remove every entry that depends on it
+
+        :return: list of keys removed
+        '''
+        keys = list(self._users.get(name, ()))
+        for key in keys:
+            self.discard(key)
+        self.invalidations += len(keys)
+        return keys
+
+    def clear(self):
+        '''Remove everything'''
+        self._values.clear()
+        self._depends.clear()
+        self._users.clear()
@@ -0,0 +1,29 @@
+'''
+A snapshot of everything the output functions need
+
+Writing a BASH fragment, a Makefile fragment and JSON all start the same
+way: put the macros in order and resolve every value. That work is done
+once and kept as a MacroEmission, every output format is produced from it.
+'''
+
+__all__ = ['MacroEmission']
+
+
+class MacroEmission(object):
+    '''
+    The ordered and resolved macros, see MacroEngine.emission()
+
+    This is only valid while the macros do not change, the engine
+    compares version against its own and builds a new one as needed.
+    '''
+
+    def __init__(self, version, order, array):
+        self.version = version
+        '''The engine version this was built from'''
+        self.order = order
+        '''Macro names in output order, see MacroEngine.output_order()'''
+        self.array = array
+        '''The output dicts, see MacroEngine.output_array(), do not modify these'''
+
+    def __len__(self):
+        return len(self.array)
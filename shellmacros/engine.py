@@ -3,23 +3,34 @@ This is the macro engine, it does the work of resolving macros
 and managing your list of macros and their values.
 '''
 import os
+import asyncio
+import heapq
+import concurrent.futures
 import json
-import re
+import logging
 
-from .entry import MacroEntry
-from .result import MacroResult
-from .exceptions import MacroSyntaxError, MacroUndefinedError, MacroRecursionError, MacroNonAsciiError
+from .entry import MacroEntry, validate_names
+from .result import MacroResult, MAX_RECURSION
+from .exceptions import MacroSyntaxError, MacroUndefinedError, MacroRecursionError
 from .istr import IStr
+from .table import MacroTable
+from .cache import DependencyCache
+from .matcher import ValueMatcher
+from .stream import read_lines, stream_name
+from .snapshot import write_snapshot, read_snapshot
+from .loaders import json_entries, env_file_entries, make_fragment_entries
+from .parallel import engine_snapshot, resolve_chunk, _worker_init, _worker_resolve
+from .emission import MacroEmission
+from .environment import EnvironmentSnapshot
+from .template import TemplateCache, TemplateFallback, DEFAULT_CACHE_SIZE
+from .asciicheck import AsciiChecker, check_ascii
+from .instrument import Instrumentation, install, uninstall
+from .trace import logger as _trace
 
 FORMAT_MAJOR = 1
 FORMAT_MINOR = 0
-# This regex matches the first NON matching value
-# \x0a = ASCII NEWLINE, ie: \n
-# \x20 = ASCII SPACE
-# \x7F = ASCII delete, we don't want that
-# Thus (0x0a) + range(0x20 to 0x7e) is good
-# the ^ at start means NOT
-_non_ascii_regex = re.compile(r'[^\n -~]')
+# how much output the write_*() functions check and write at a time
+_WRITE_CHUNK = 64 * 1024
 
 def _normalize_slash( s, slash_f, slash_t ):
     # internal not plublic function
@@ -59,6 +70,136 @@ def _bash_quoted(s):
     return _make_quoted(s)
 
 
+def _to_dos(value):
+    # internal not public function, the _dos transform
+    return _normalize_slash( value, '/', '\\' )
+
+
+def _to_unix(value):
+    # internal not public function, the _unix transform
+    # note: this has always made DOS slashes, see test_C020_transfors
+    return _normalize_slash( value, '/', '\\' )
+
+
+DEFAULT_TRANSFORMS = (('_uc', str.upper), ('_lc', str.lower), ('_dos', _to_dos), ('_unix', _to_unix))
+'''The macro suffixes every engine starts with, see MacroEngine.add_transform()'''
+
+
+def _joined_lines(lines, batch=1000):
+    # internal, '\n'.join(lines) in pieces of batch lines
+    for start in range(0, len(lines), batch):
+        if start:
+            yield '\n'
+        yield '\n'.join(lines[start:start + batch])
+
+
+def _where(error, filename, lineno):
+    # internal not public function
+    # the same error, with the filename and line number in the message
+    return error.__class__("%s:%d: %s" % (filename, lineno, error))
+
+
+def _line_bodies(lines, endings):
+    # internal not public function
+    # generator, yields each line without its line ending
+    # the ending is put in endings (which holds at most one), see resolve_lines()
+    for line in lines:
+        if line.endswith('\r\n'):
+            endings.append('\r\n')
+            line = line[:-2]
+        elif line.endswith('\n'):
+            endings.append('\n')
+            line = line[:-1]
+        else:
+            endings.append('')
+        yield line
+
+
+def _for_macro(error, name):
+    # internal not public function
+    # the same error, with the macro name in the message
+    return error.__class__("macro %s: %s" % (name, error))
+
+
+def _strongly_connected(graph):
+    # internal not public function
+    # Tarjan's algorithm, graph is a dict: name -> list of names
+    # returns the strongly connected components, as lists of names
+    edges = dict()
+    for name, deps in graph.items():
+        edges[name] = [dep for dep in deps if dep in graph]
+    index = dict()
+    lowlink = dict()
+    stack = []
+    on_stack = set()
+    result = []
+    for start in sorted(graph.keys()):
+        if start in index:
+            continue
+        # iterative, tables can be deeper then python recursion allows
+        work = [(start, 0)]
+        while len(work):
+            name, pos = work.pop()
+            if pos == 0:
+                index[name] = lowlink[name] = len(index)
+                stack.append(name)
+                on_stack.add(name)
+            for pos in range(pos, len(edges[name])):
+                dep = edges[name][pos]
+                if dep not in index:
+                    # come back to this name when done with dep
+                    work.append((name, pos + 1))
+                    work.append((dep, 0))
+                    break
+                if dep in on_stack:
+                    lowlink[name] = min(lowlink[name], index[dep])
+            else:
+                if lowlink[name] == index[name]:
+                    scc = []
+                    while True:
+                        dep = stack.pop()
+                        on_stack.discard(dep)
+                        scc.append(dep)
+                        if dep == name:
+                            break
+                    result.append(scc)
+                if len(work):
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[name])
+    return result
+
+
+class _ExpandState(object):
+    # internal, the book keeping for one compiled resolve
+    def __init__(self, references, memo=None):
+        # the MacroResult.references list we append to
+        self.references = references
+        # number of replacements made so far
+        self.steps = 0
+        # macros currently being expanded, used to detect cycles
+        self.active = set()
+        # if not None, a dict shared by several resolves (see resolve_many)
+        # key: macro name as referenced, value: an _Expansion
+        self.memo = memo
+
+
+class _Expansion(object):
+    # internal, what expanding one ${name} did, so it can be done again
+    # without looking up, transforming or expanding anything
+    def __init__(self, m, marked):
+        # the macro that was found
+        self.m = m
+        # if true, ${name} was kept as is
+        self.marked = marked
+        # the text appended, as a list of strings
+        self.pieces = ()
+        # which pieces are kept ${name}s
+        self.kept = ()
+        # MacroResult.references appended, after m
+        self.references = ()
+        # number of replacements made
+        self.steps = 0
+
 
 class MacroEngine(object):
     '''
@@ -69,41 +210,293 @@ class MacroEngine(object):
     RESOLVE_FULLY = 1
     RESOLVE_REFERENCES = 2
 
-    def __init__(self):
+    RESOLVER_COMPILED = 0
+    RESOLVER_REFERENCE = 1
+
+    def __init__(self, template_cache_size=DEFAULT_CACHE_SIZE):
         self.debug = False
-        self.macros = dict()
+        self.instrumentation = None
+        '''The Instrumentation counting what this engine does, see instrumentation_enable()'''
+        self.macros = MacroTable(self._macro_changed, self._macros_changed)
         '''The macros, key: macro name, item=MacroEntry()'''
         self.use_env = False
         '''Should SHELL env variables be auto imported?'''
+        self.environment = None
+        '''Where env variables come from, an EnvironmentSnapshot see add_environment()
+
+        If None when use_env is set, a snapshot of os.environ is taken when first needed.
+        '''
+        # (environment, version) last seen, see _check_environment()
+        self._env_state = None
+        # names known not to be a macro, a variant or in the environment, see _find_macro()
+        self._missing = set()
         self.ascii_check = True
         '''Should result strings be verified they are 100% pure ascii text?'''
-        self._cache = dict()
+        self.resolver = self.RESOLVER_COMPILED
+        '''Which resolver resolve_text() uses
+
+        RESOLVER_COMPILED tokenizes the text once and resolves it in a single pass.
+        RESOLVER_REFERENCE is the original one-macro-per-pass resolver, it is
+        kept so the two can be compared against each other (differential testing)
+        '''
+        self.template_cache = TemplateCache(template_cache_size)
+        '''Compiled templates, see set_template_cache_size()'''
+        self.history_level = MacroResult.HISTORY_ENDS
+        '''How much of MacroResult.history is kept
+
+        MacroResult.HISTORY_OFF, HISTORY_ENDS (the original and final text)
+        or HISTORY_FULL (also the text after every replacement, this is slow)
+        '''
+        self.transforms = dict(DEFAULT_TRANSFORMS)
+        '''Macro suffixes and their transform functions, see add_transform()'''
+        # suffix variants of macro names, ie: foo_lc -> ('foo', '_lc')
+        self._variants = dict()
+        # per suffix, the suffixes a name ending with it might have, see _index_name()
+        self._suffix_alts = dict()
+        # transformed values, key: variant name, see _macro_value()
+        self._transformed = DependencyCache()
+        self._update_suffixes()
+        # resolved values, key: macro name, see cache_update()
+        self._cache = DependencyCache()
+        # macros that need to be resolved on the next cache_update()
+        self._dirty = dict()
+        # bumped every time a macro changes
+        self._version = 0
+        # reverse lookup for unresolve_text() and the version it was built for
+        self._matcher = None
+        self._matcher_version = None
+        # the ordered and resolved macros, see emission()
+        self._emission = None
+        # (version, output order) if known without calculating, see load_snapshot()
+        self._known_order = None
+        # async value providers for external macros, see add_provider()
+        self._providers = []
+        # values fetched by providers, name -> value (None if the provider had none)
+        self._fetched = dict()
+        # fetches in progress, name -> asyncio task
+        self._fetching = dict()
 
     def debug_enable(self):
+        '''Trace what this engine does to the 'shellmacros' logger, see trace.py'''
         self.debug = True
     def debug_disable(self):
         self.debug = False
 
+    def _tracing(self):
+        # internal function, should this engine trace now? see trace.py
+        return self.debug and _trace.isEnabledFor(logging.DEBUG)
+
+    def instrumentation_enable(self, instrumentation=None):
+        '''
+        Count what this engine does, returns the Instrumentation
+
+        :param instrumentation: An Instrumentation (or subclass), None makes a new one
+
+        See instrument.py, instrumentation.report() gives a summary. One
+        Instrumentation may be given to several engines, to count them all.
+        '''
+        self.instrumentation_disable()
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+        install(self, instrumentation)
+        self.instrumentation = instrumentation
+        return instrumentation
+
+    def instrumentation_disable(self):
+        '''Stop counting, returns the Instrumentation that was counting (or None)'''
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            uninstall(self)
+            instrumentation.on_disable(self)
+            self.instrumentation = None
+        return instrumentation
+
+    def set_template_cache_size(self, size):
+        '''
+        Set how many compiled templates are remembered, 0 disables the cache
+
+        Counters are found in engine.template_cache.stats()
+        '''
+        self.template_cache.resize(size)
+
     def cache_reset( self ):
         '''
         Resets/empties the name/value cache
         '''
-        self._cache = dict()
+        self._cache.clear()
+        self._dirty = dict.fromkeys(self.macros)
+        self._version += 1
         
     def cache_update( self ):
         '''
         Convert and expand every name/value in the normal way.
+
+        The results are kept, along with the macros each result depends upon.
+        Only macros that changed (or depend on a macro that changed) since the
+        last update are resolved again.
         '''
+        self._check_environment()
+        self._cache_dirty()
+
+    def _cache_dirty(self):
+        # internal function, resolves and keeps the macros in self._dirty
+        tracing = self._tracing()
+        while len(self._dirty):
+            # note: resolving may add macros (from the environment)
+            # those are picked up by the next time around this loop
+            names = []
+            for n in list(self._dirty):
+                v = self.macros.get(n, None)
+                if (v is None) or (v.value is None):
+                    del self._dirty[n]
+                    continue
+                names.append(n)
+            values = [self.macros[n].value for n in names]
+            for n, r in zip(names, self.resolve_many(values, self.RESOLVE_NORMAL, lazy=True)):
+                if tracing:
+                    _trace.debug("cache: %s=%s", n, r.original)
+                if not r.ok:
+                    raise r.error
+                depends = [m.name for m in r.references]
+                depends.append(n)
+                self._cache.put(n, r.result, depends)
+                self._dirty.pop(n, None)
+
+    def resolve_all(self, how=RESOLVE_NORMAL, workers=None, chunk_size=None):
+        '''
+        Resolve the value of every macro, returns a dict: name -> resolved text
+
+        :param how: RESOLVE_NORMAL, RESOLVE_FULLY or RESOLVE_REFERENCES
+        :param workers: None or 1 to work in this process, N>1 uses N processes
+        :param chunk_size: How many macros to send a worker at a time
+
+        With workers the table is sent (once) to each worker process and the
+        macros are resolved in chunks, a large table can use every core.
+        The result is the same either way, in the same order as the table.
+
+        Macros without a value are skipped. If any macro cannot be resolved
+        the error of the first such macro is raised, the message names the macro.
+
+        For RESOLVE_NORMAL the results are also kept, see cache_update()
+        '''
+        names = [name for name, m in self.macros.items() if m.value is not None]
+        if (workers is None) or (workers <= 1) or (len(names) < 2):
+            answers = resolve_chunk(self, names, how)
+        else:
+            if chunk_size is None:
+                # a few chunks per worker, so a slow chunk does not hold up the rest
+                chunk_size = max(1, -(-len(names) // (workers * 4)))
+            jobs = [(names[x:x + chunk_size], how) for x in range(0, len(names), chunk_size)]
+            answers = []
+            with concurrent.futures.ProcessPoolExecutor(workers, initializer=_worker_init,
+                                                        initargs=(engine_snapshot(self),)) as pool:
+                # note: map() gives the results in job order
+                for chunk in pool.map(_worker_resolve, jobs):
+                    answers.extend(chunk)
+        result = dict()
+        error = None
+        for name, (ok, text, err, depends) in zip(names, answers):
+            if not ok:
+                if error is None:
+                    error = _for_macro(err, name)
+                continue
+            result[name] = text
+            if how == self.RESOLVE_NORMAL:
+                depends.append(name)
+                self._cache.put(name, text, depends)
+                self._dirty.pop(name, None)
+        if error is not None:
+            raise error
+        return result
+
+    def _macro_changed(self, name):
+        # internal function, the macro table calls this
+        # when a macro is added, removed or changed
+        self._version += 1
+        self._missing.clear()
+        self._index_name(name)
+        self._transformed.invalidate(name)
+        for n in (name, self._variant_base(name)):
+            for key in self._cache.invalidate(n):
+                self._dirty[key] = None
+        self._dirty[name] = None
+
+    def _macros_changed(self, names):
+        # internal function, the macro table calls this
+        # when many macros are added at once
+        self._version += 1
+        self._missing.clear()
+        for name in names:
+            self._index_name(name)
+        if len(self._transformed):
+            for name in names:
+                self._transformed.invalidate(name)
+        if len(self._cache):
+            for name in names:
+                for n in (name, self._variant_base(name)):
+                    for key in self._cache.invalidate(n):
+                        self._dirty[key] = None
+        self._dirty.update(dict.fromkeys(names))
+
+    def add_transform(self, suffix, func):
+        '''
+        Add (or replace) a macro suffix, ie: ${foo_lc} is ${foo} in lower case
+
+        :param suffix: The suffix, for example: "_lc"
+        :param func: Called with the value of the macro, returns the transformed value
+
+        Suffixes are tried in the order they where added. Transformed values are
+        remembered until the macro changes, func should only depend on the value.
+        For resolve_all(workers=N) func must be picklable (a module level function)
+        '''
+        if not suffix:
+            raise ValueError("bad suffix: %r" % suffix)
+        self.transforms[suffix] = func
+        self._update_suffixes()
         self.cache_reset()
-        self._cache = dict()
-        for n, v in self.macros.items():
-            if self.debug:
-                print("%s=%s" % (n,v.value))
-            if v.value is None:
+
+    def _update_suffixes(self):
+        # internal function, the set of suffixes changed, rebuild the variant index
+        self._suffix_alts = dict()
+        for suffix in self.transforms:
+            # ie: with "_x" and "_y_x", foo_y_x is either foo_y + _x or foo + _y_x
+            self._suffix_alts[suffix] = [s for s in self.transforms
+                                         if s.endswith(suffix) or suffix.endswith(s)]
+        self._variants = dict()
+        for name in self.macros:
+            self._index_name(name)
+        self._transformed.clear()
+        self._missing.clear()
+
+    def _index_name(self, name):
+        # internal function, this macro was added or removed, update its suffix variants
+        for suffix in self.transforms:
+            key = name + suffix
+            old = self._variants.get(key, None)
+            new = None
+            for alt in self._suffix_alts[suffix]:
+                if key.endswith(alt) and (key[:-len(alt)] in self.macros):
+                    # the first suffix added wins
+                    new = (key[:-len(alt)], alt)
+                    break
+            if new == old:
                 continue
-            v = self.resolve_simple( v.value, self.RESOLVE_NORMAL );
-            self._cache[n] = v
-    
+            if new is None:
+                del self._variants[key]
+            else:
+                self._variants[key] = new
+            if old is not None:
+                # ${key} was a variant of another macro until now
+                self._transformed.discard(key)
+                for k in self._cache.invalidate(old[0]):
+                    self._dirty[k] = None
+
+    def _variant_base(self, name):
+        # internal function, the macro name is a suffix variant of, or name
+        v = self._variants.get(name, None)
+        if v is None:
+            return name
+        return v[0]
 
     def add(self, name, value):
         '''Add a standard macro, ie: name = value, returns the added macro'''
@@ -111,6 +504,75 @@ class MacroEngine(object):
         self.macros[name] = m
         return m
 
+    def add_many(self, macros, keep=False, external=False):
+        '''Add many macros at once, returns the list of added macros
+
+        :param macros: A dict of name->value, or an iterable of (name,value)
+        :param keep: Mark every macro as keep, see add_keep()
+        :param external: Mark every macro as external, see add_external()
+
+        The names are checked before anything is added, cached results
+        are updated once at the end rather then once per macro.
+        '''
+        if hasattr(macros, 'items'):
+            macros = macros.items()
+        pairs = list(macros)
+        validate_names([name for name, value in pairs])
+        entries = []
+        for name, value in pairs:
+            m = MacroEntry(name, value, validate=False)
+            if keep:
+                m.keep = True
+            if external:
+                m.external = True
+            entries.append(m)
+        self.macros.add_entries(entries)
+        return entries
+
+    def load_json(self, source):
+        '''Add the macros from json_macros_str(), returns the list of added macros
+
+        :param source: A filename or a file object
+        '''
+        if hasattr(source, 'read'):
+            obj = json.load(source)
+        else:
+            with open(source, 'r', encoding='utf-8') as f:
+                obj = json.load(f)
+        if obj.get('major', None) != FORMAT_MAJOR:
+            raise MacroSyntaxError('unsupported JSON format: %s.%s' % (obj.get('major'), obj.get('minor')))
+        entries = json_entries(obj['macros'])
+        self.macros.add_entries(entries)
+        return entries
+
+    def load_env_file(self, source, encoding='utf-8'):
+        '''Add the macros from a shell KEY=VALUE file, returns the list of added macros
+
+        This reads bash_fragment_str() output, and simple hand written files
+
+        :param source: A filename or a file object
+        '''
+        entries = env_file_entries(read_lines(source, encoding=encoding), self._source_name(source))
+        self.macros.add_entries(entries)
+        return entries
+
+    def load_make_fragment(self, source, encoding='utf-8'):
+        '''Add the macros from a makefile fragment, returns the list of added macros
+
+        This reads make_fragment_str() output, and simple hand written files
+
+        :param source: A filename or a file object
+        '''
+        entries = make_fragment_entries(read_lines(source, encoding=encoding), self._source_name(source))
+        self.macros.add_entries(entries)
+        return entries
+
+    def _source_name(self, source):
+        # internal function, the name of a file for error messages
+        if hasattr(source, 'read'):
+            return stream_name(source)
+        return os.fsdecode(source)
+
     def add_makefle_dynamic_vars(self):
         '''Add makefile symbolic macros as KEEP & EXTERNAL'''
         for txt in "@%<?^+|*?":
@@ -132,9 +594,44 @@ class MacroEngine(object):
         '''Disable accii output checks'''
         self.ascii_check = False
 
-    def add_environment(self):
-        '''Enable use of ENV variables'''
+    def add_environment(self, environment=None):
+        '''
+        Enable use of ENV variables
+
+        :param environment: An EnvironmentSnapshot, default: a snapshot of os.environ taken now
+
+        Variables are looked up in the snapshot, not os.environ, so later changes
+        to the environment are not seen. Unless the snapshot has track_changes set,
+        or refresh() is called on it.
+        '''
         self.use_env = True
+        if environment is None:
+            environment = EnvironmentSnapshot()
+        self.environment = environment
+        self.cache_reset()
+
+    def add_provider(self, provider, names=None):
+        '''
+        Add an async value provider for external macros, see aresolve_text()
+
+        :param provider: An async function, provider(name) returns the value or None
+        :param names: The macro names this provider knows about, None means all
+
+        Providers are asked in the order they where added.
+        '''
+        if names is not None:
+            names = frozenset(names)
+        self._providers.append((provider, names))
+
+    def forget_fetched(self):
+        '''
+        Forget all values fetched by providers, they will be fetched again when needed
+        '''
+        for name, value in self._fetched.items():
+            m = self.macros.get(name, None)
+            if (m is not None) and (value is not None) and (m.value == value):
+                m.value = None
+        self._fetched.clear()
 
     def add_keep(self, name, value):
         '''Add a macro that should not normally be expanded, returns the added macro'''
@@ -149,6 +646,7 @@ class MacroEngine(object):
         m = self.macros.get( name, None )
         if m is None:
             raise KeyError("no such macro named: %s" % name )
+        # note: the macro tells the table, which updates our cache
         m.keep = True
 
     def mark_macro_external(self, name):
@@ -161,70 +659,76 @@ class MacroEngine(object):
         m.external = True
 
     def unresolve_text( self, text, how = RESOLVE_NORMAL ):
-        old = None
-        done = False
+        '''
+        The reverse of resolve_text(), replace macro values found in text with ${name}
+
+        The heuristic is GREEDY, the longest value found is replaced first
+        if values are the same length, the first macro defined wins.
+        '''
         passes = 0
-        history = [];
+        tracing = self._tracing()
         self.cache_update()
+        matcher = self._value_matcher()
         text = self.resolve_simple( text, how )
-        while not done:
-            if self.debug:
-                print("TEXT = %s" % text )
-            longest = None
-            if len( history ) > 50:
+        while True:
+            if tracing:
+                _trace.debug("unresolve: %s", text)
+            if passes > 50:
                 # Recursion has gone crazy
                 raise MacroRecursionError("Unresolve Recursion?")
-               
-            for name,value in self._cache.items():
-                # does the text contain this macro?
-                if value not in text:
-                    # Nope, then move on.
-                    if self.debug:
-                        print("NOT FOUND:     text: %s" % text )
-                        print("NOT FOUND: canidate: %s" % value )
-                    continue
-
-                if self.debug:
-                    print("MATCH:     name: %s" % name )
-                    print("MATCH: canidate: %s" % value )
-                    print("MATCH:     text: %s" % text )
-                
-                # Our heuristic here is: GREEDY
-                # We want the longest transform
-                if longest is None:
-                    longest = (name,value)
-                    continue
-                # Is new value a better(heuristic: greedy)
-                if len(value) > len(longest[1]):
-                    if self.debug:
-                        print("old: %s=%s" % (longest[0],longest[1]) )
-                        print("new: %s=%s" % (name,value))
-                    longest = (name,value)
+            longest = matcher.best(text)
+            if (longest is None) and (matcher.empty is not None):
+                # the empty string is always found, and is found again
+                # after every replacement, we would go round forever
+                raise MacroRecursionError("Unresolve Recursion?")
             # if nothing found we are done.
             if longest is None:
-                done = True
-                continue
+                break
             # We have a canidate to replace with.
             # [0] = macro name
             # [1] = macro value
-            if self.debug:
-                print("TEXT: %s" % text )
-                print("replace with %s=%s" % (longest[0], longest[1] ))
-            newtext = text.replace( longest[1], "${" + longest[0] + "}" )
-            history.append( (text, newtext) )
-            text = newtext
+            if tracing:
+                _trace.debug("unresolve: replace with %s=%s", longest[0], longest[1])
+            text = text.replace( longest[1], "${" + longest[0] + "}" )
+            passes += 1
 
-        if self.debug:
-            print("DONE, result: %s" % text )
+        if tracing:
+            _trace.debug("unresolve: done, result: %s", text)
         return text;
 
+    def _value_matcher(self):
+        # internal function
+        # The reverse lookup of cached values, rebuilt when the cache changes
+        if (self._matcher is None) or (self._matcher_version != self._version):
+            pairs = []
+            values = self._resolved_values()
+            if values is None:
+                values = self._cache
+            for name in self.macros:
+                value = values.get(name, None)
+                if value is not None:
+                    pairs.append((name, value))
+            self._matcher = ValueMatcher(pairs)
+            self._matcher_version = self._version
+        return self._matcher
 
     def resolve_simple( self, text, how=RESOLVE_NORMAL ):
-        r = self.resolve_text( text, how )
+        '''Same as resolve_text(), but returns the resolved text or raises the error'''
+        if '$' not in text:
+            # nothing to resolve
+            return text
+        self._check_environment()
+        if (self.resolver == self.RESOLVER_COMPILED) and not self.debug:
+            # only the text is wanted, skip making a MacroResult
+            try:
+                return self._expand_text(text, how, [])[0]
+            except TemplateFallback:
+                pass
+        r = self._resolve( text, how, None )
         if not r.ok:
-            raise r.error()
+            raise r.error
         return r.result
-        
+
     def resolve_text(self, text, how=RESOLVE_NORMAL):
         '''Given text - resolve macros found in this text.
 
@@ -252,8 +756,152 @@ class MacroEngine(object):
            somefilename.txt:134: error undefined: FOO
         '''
 
+        self._check_environment()
+        return self._resolve(text, how, None)
+
+    async def aresolve_text(self, text, how=RESOLVE_NORMAL, concurrency=8):
+        '''Async version of resolve_text(), values of external macros are fetched as needed
+
+        External macros without a value, found while resolving text, are fetched
+        from the providers (see add_provider()) at the same time, at most
+        concurrency fetches run at once. A fetched value becomes the value of the
+        macro, it is fetched only once (see forget_fetched()).
+
+        Fetched values may refer to other macros, those are fetched in turn.
+        Then the text is resolved as resolve_text() would.
+
+        Note: RESOLVE_NORMAL keeps external macros as is, nothing is fetched.
+        '''
+        while how != self.RESOLVE_NORMAL:
+            r = self.resolve_text(text, self.RESOLVE_REFERENCES)
+            names = []
+            for m in r.references:
+                if m.external and (m.value is None) and (m.name not in self._fetched):
+                    if (m.name not in names) and (self._provider_for(m.name) is not None):
+                        names.append(m.name)
+            if len(names) == 0:
+                break
+            limit = asyncio.Semaphore(concurrency)
+            await asyncio.gather(*[self._fetch(name, limit) for name in names])
+        return self.resolve_text(text, how)
+
+    def _provider_for(self, name):
+        # internal function, the provider to ask for this macro, or None
+        for provider, names in self._providers:
+            if (names is None) or (name in names):
+                return provider
+        return None
+
+    async def _fetch(self, name, limit):
+        # internal function, fetch the value of this external macro
+        # if someone else is already fetching it, wait for them
+        task = self._fetching.get(name)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_one(name, limit))
+            self._fetching[name] = task
+        try:
+            await task
+        finally:
+            if self._fetching.get(name) is task:
+                del self._fetching[name]
+
+    async def _fetch_one(self, name, limit):
+        # internal function, see _fetch()
+        async with limit:
+            value = await self._provider_for(name)(name)
+        self._fetched[name] = value
+        m = self.macros.get(name, None)
+        if (value is not None) and (m is not None) and (m.value is None):
+            m.value = value
+
+    def resolve_many(self, texts, how=RESOLVE_NORMAL, lazy=False):
+        '''Resolve many texts, returns a list of MacroResult() one per text
+
+        If lazy is True, a generator of MacroResult()s is returned instead.
+
+        Each result is exactly what resolve_text() would return for that text,
+        but work is shared across the texts: macros are looked up, transformed
+        (ie: _lc/_uc/_dos/_unix) and expanded once for the whole batch.
+        '''
+        results = self._resolve_many(texts, how)
+        if lazy:
+            return results
+        return list(results)
+
+    def _resolve_many(self, texts, how):
+        # internal function, see resolve_many()
+        self._check_environment()
+        memo = dict()
+        version = self._version
+        for text in texts:
+            if version != self._version:
+                # a macro changed, what we learned so far is stale
+                memo = dict()
+                version = self._version
+            yield self._resolve(text, how, memo)
+
+    def resolve_lines(self, lines, how=RESOLVE_NORMAL, filename='<input>'):
+        '''Generator, resolve each line and yield the resulting text
+
+        Unlike resolve_text() errors are raised, the message starts with
+        "filename:lineno:" so the user knows where the problem is.
+        '''
+        # line endings are not part of the text resolved (or of the errors)
+        endings = []
+        results = self.resolve_many(_line_bodies(lines, endings), how, lazy=True)
+        for lineno, r in enumerate(results, 1):
+            end = endings.pop()
+            if not r.ok:
+                raise _where(r.error, filename, lineno)
+            yield r.result + end
+
+    def resolve_stream(self, infile, outfile, how=RESOLVE_NORMAL, use_mmap=None, encoding='utf-8'):
+        '''Resolve macros in a file, line by line, writing the result to outfile
+
+        Only one line at a time is held in memory.
+
+        :param infile: A filename or a file object to read
+        :param outfile: A filename or a file object to write
+        :param use_mmap: Read via mmap? True, False or None for large files only
+        :param encoding: Used to read/write files given by name
+        :return: The number of lines written
+
+        Errors are raised with the filename and line number, see resolve_lines()
+        '''
+        filename = self._source_name(infile)
+        lines = read_lines(infile, use_mmap, encoding)
+        if not hasattr(outfile, 'write'):
+            with open(outfile, 'w', encoding=encoding, newline='') as f:
+                return self._write_lines(f, self.resolve_lines(lines, how, filename))
+        return self._write_lines(outfile, self.resolve_lines(lines, how, filename))
+
+    def _write_lines(self, f, lines):
+        # internal function, see resolve_stream()
+        count = 0
+        for line in lines:
+            f.write(line)
+            count += 1
+        return count
+
+    def _resolve(self, text, how, memo):
+        # internal function, see resolve_text()
+        # memo is None, or shared by several resolves see resolve_many()
         # Get our result
-        result = MacroResult(text)
+        result = MacroResult(text, self.history_level)
+        if result.done:
+            return result
+
+        if self.resolver == self.RESOLVER_COMPILED:
+            try:
+                self._resolve_compiled(result, how, memo)
+                if self.debug:
+                    self._trace_result(result)
+                return result
+            except TemplateFallback:
+                # Not something we can do in one pass, or an error.
+                # Start over the slow way so the result (and error text)
+                # is exactly what the reference resolver produces
+                result = MacroResult(text, self.history_level)
 
         # Loop till done
         while not result.done:
@@ -261,40 +909,90 @@ class MacroEngine(object):
             #       in the 'result.update' operation
             self._resolve_pass(result, how)
 
+        if self.debug:
+            self._trace_result(result)
         return result
 
+    def _trace_result(self, result):
+        # internal function, see trace.py
+        if not _trace.isEnabledFor(logging.DEBUG):
+            return
+        if result.ok:
+            _trace.debug("resolve: %s -> %s (%d steps)", result.original, result.result, result.steps)
+        else:
+            _trace.debug("resolve: %s -> error: %s", result.original, result.error)
+
     def _find_macro(self, name):
         # Internal function
         # find this macro
-        # handle finding _dos/unix/_lc/_uc varients
-        for passnum in (1, 2):
-            # passnum = 1, original name
-            # passnum = 2, handle uc/lc/dos/unix
-            m = self.macros.get(name, None)
-            if m:
-                # found
-                return m
-            if self.use_env:
-                e = os.getenv(name, None)
-                if e:
-                    # found, invent a macro so we know about it
-                    m = MacroEntry(name, e)
-                    # mark as an env macro
-                    self.macrs[ name ] = m
-                    m.env = True
+        # handle finding _dos/unix/_lc/_uc (see transforms) varients
+        # the order is: name, env name, variant, env variant
+        m = self.macros.get(name, None)
+        if m:
+            # found
+            return m
+        if name in self._missing:
+            # not found last time either
+            return None
+        if self.use_env:
+            m = self._env_macro(name)
+            if m is not None:
                 return m
-            if passnum == 2:
-                continue
-            # between pass 1 & 2, we remove the suffixes
-            if (name[-3:] in ('_uc', '_lc')):
-                name = name[:-3]
-            elif name.endswith('_dos'):
-                name = name[:-4]
-            elif name.endswith('_unix'):
-                name =name[:-5]
-            continue
+        # a suffix variant? one lookup, see _index_name()
+        v = self._variants.get(name, None)
+        if v is not None:
+            return self.macros[v[0]]
+        if self.use_env:
+            for suffix in self.transforms:
+                if name.endswith(suffix) and (len(name) > len(suffix)):
+                    m = self._env_macro(name[:-len(suffix)])
+                    if m is not None:
+                        return m
+        # note: any change to the macros forgets these
+        self._missing.add(name)
         return None
 
+    def _env_macro(self, name):
+        # Internal function
+        # look for name in the environment, see add_environment()
+        e = self.environment.get(name, None)
+        if e is None:
+            return None
+        # found, invent a macro so we know about it
+        m = MacroEntry(name, e, validate=False)
+        # mark as an env macro
+        m.env = True
+        self.macros[name] = m
+        return m
+
+    def _check_environment(self):
+        # Internal function
+        # called before resolving, notices a new or changed environment
+        env = None
+        if self.use_env:
+            env = self.environment
+            if env is None:
+                env = self.environment = EnvironmentSnapshot()
+            if env.track_changes:
+                env.refresh()
+        state = None if env is None else (env, env.version)
+        if state == self._env_state:
+            return
+        self._env_state = state
+        self._missing.clear()
+        if env is None:
+            return
+        # the macros that came from the environment get the new values
+        # note: dict.items() is only the macros held here, not those of a parent see child()
+        for name, m in list(dict.items(self.macros)):
+            if not m.env:
+                continue
+            e = env.get(name, None)
+            if e is None:
+                del self.macros[name]
+            elif e != m.value:
+                m.value = e
+
     def _resolve_pass(self, result, how):
         # internal function
         # This makes one pass across the text, replacing 1 macro
@@ -319,48 +1017,266 @@ class MacroEngine(object):
         # what are we going to do?
         # REPLACE text or
         # MARK text?
-
-        # Assume we will mark
-        action_mark = False
-        if how == self.RESOLVE_NORMAL:
-            if (m.keep or m.external):
-                action_mark = True
-            else:
-                action_mark = False
-        elif how == self.RESOLVE_FULLY:
-            action_mark = False
-        elif how == self.RESOLVE_REFERENCES:
-            if m.external and (m.value is None):
-                action_mark = True
-            else:
-                action_mark = False
-
-        if action_mark:
+        if self._action_mark(m, how):
             result.mark(mresult.lhs, mresult.rhs, result.IGNORE)
             return
 
-        value = m.value
+        value = self._macro_value(m, mresult.name)
         if value is None:
             result.declare_novalue(mresult.name)
             return
 
-        # We are going to replace
+        result.replace(mresult.lhs, mresult.rhs, value)
+        return
+
+    def _action_mark(self, m, how):
+        # internal function
+        # Should this macro be marked (kept as is) rather then replaced?
+        if how == self.RESOLVE_NORMAL:
+            return m.keep or m.external
+        if how == self.RESOLVE_REFERENCES:
+            return m.external and (m.value is None)
+        # RESOLVE_FULLY
+        return False
+
+    def _macro_value(self, m, name):
+        # internal function
+        # The replacement text for ${name}, which was found as macro m
+        value = m.value
+        if value is None:
+            return None
+
+        if m.name == name:
+            if m.quoted:
+                value = '"%s"' % value
+            return value
+
+        # a suffix variant, transformed once until the macro changes
+        value = self._transformed.get(name, None)
+        if value is None:
+            value = self._transform(m, name)
+            self._transformed.put(name, value, (m.name, name))
+        return value
+
+    def _transform(self, m, name):
+        # internal function
+        # The value of ${name}, a suffix variant of macro m
+        v = self._variants.get(name, None)
+        if (v is None) or (v[0] != m.name):
+            raise NotImplementedError("What is this: %s != %s" % (m.name,name))
+        value = m.value
         if m.quoted:
             value = '"%s"' % value
+        return self.transforms[v[1]](value)
 
-        if m.name != mresult.name:
-            if mresult.name.endswith('_lc'):
-                value = str.lower(value)
-            elif mresult.name.endswith('_uc'):
-                value = str.upper(value)
-            elif mresult.name.endswith('_dos'):
-                value = _normalize_slash( value, '/', '\\' )
-            elif mresult.name.endswith('_unix'):
-                value = _normalize_slash( value, '/', '\\' )
-            else:
-                raise NotImplementedError("What is this: %s != %s" % (m.name,mresult.name))
-        result.replace(mresult.lhs, mresult.rhs, value)
-        return
+    def _resolve_compiled(self, result, how, memo=None):
+        # internal function
+        # Resolve the entire text in one pass over its compiled template.
+        # Raises TemplateFallback if the reference resolver must do this.
+        text, steps = self._expand_text(result.original, how, result.references, memo)
+        result.steps = steps
+        result.declare_success(text)
+
+    def _expand_text(self, text, how, references, memo=None):
+        # internal function, see _resolve_compiled()
+        # returns (resolved text, number of replacements made)
+        tpl = self.template_cache.compile(text, how)
+        if tpl is None:
+            raise TemplateFallback()
+        out = []
+        kept = []
+        state = _ExpandState(references, memo)
+        self._expand(tpl.parts, how, out, kept, state)
+        text = ''.join(out)
+        self._final_check(text, out, kept)
+        return text, state.steps
+
+    def _expand(self, parts, how, out, kept, state):
+        # internal function
+        # Append the expansion of template parts to out
+        # the index of each kept (marked) ${name} within out is added to kept
+        for p in parts:
+            if isinstance(p, str):
+                out.append(p)
+                continue
+            name = p.name
+            if name is None:
+                # nested, ie: ${${a}_${b}} - expand the name first
+                tmp = []
+                self._expand(p.parts, how, tmp, [], state)
+                name = ''.join(tmp)
+                if (name == '') or ('$' in name):
+                    raise TemplateFallback()
+            if state.memo is None:
+                self._expand_reference(name, how, out, kept, state)
+                continue
+            x = state.memo.get(name)
+            if x is None:
+                # first time, remember what happens
+                x = self._expand_reference(name, how, out, kept, state)
+                state.memo[name] = x
+                continue
+            # we have done this before, do it again
+            state.references.append(x.m)
+            if x.marked:
+                kept.append(len(out))
+                out.append('${' + name + '}')
+                continue
+            state.steps += x.steps
+            if state.steps >= MAX_RECURSION:
+                raise TemplateFallback()
+            state.references.extend(x.references)
+            base = len(out)
+            out.extend(x.pieces)
+            for idx in x.kept:
+                kept.append(base + idx)
+
+    def _expand_reference(self, name, how, out, kept, state):
+        # internal function
+        # Append the expansion of ${name} to out, returns an _Expansion
+        # describing what was done if state.memo is in use.
+        m = self._find_macro(name)
+        if m is None:
+            # the reference resolver words the error
+            raise TemplateFallback()
+        state.references.append(m)
+        if self._action_mark(m, how):
+            kept.append(len(out))
+            out.append('${' + name + '}')
+            if state.memo is None:
+                return None
+            return _Expansion(m, True)
+        value = self._macro_value(m, name)
+        if value is None:
+            raise TemplateFallback()
+        # the reference resolver counts each replacement
+        state.steps += 1
+        if state.steps >= MAX_RECURSION:
+            raise TemplateFallback()
+        if ('$' not in value) and ('}' not in value):
+            # most common, plain text
+            out.append(value)
+            if state.memo is None:
+                return None
+            x = _Expansion(m, False)
+            x.pieces = (value,)
+            x.steps = 1
+            return x
+        tpl = self.template_cache.compile(value, how)
+        if (tpl is None) or (m in state.active):
+            raise TemplateFallback()
+        out_start = len(out)
+        kept_start = len(kept)
+        refs_start = len(state.references)
+        steps_start = state.steps
+        state.active.add(m)
+        self._expand(tpl.parts, how, out, kept, state)
+        state.active.discard(m)
+        if state.memo is None:
+            return None
+        x = _Expansion(m, False)
+        x.pieces = tuple(out[out_start:])
+        x.kept = tuple(idx - out_start for idx in kept[kept_start:])
+        x.references = tuple(state.references[refs_start:])
+        x.steps = state.steps - steps_start + 1
+        return x
+
+    def _final_check(self, text, out, kept):
+        # internal function
+        # The reference resolver makes one last search of the final text
+        # for a '$)' style macro, make sure that would find nothing.
+        if (len(text) < 4) or (')' not in text):
+            return
+        if len(kept):
+            # kept macros are marked, they cannot match
+            masked = out[:]
+            for idx in kept:
+                masked[idx] = '\0' * len(out[idx])
+            text = ''.join(masked)
+        rhs = text.find(')')
+        if rhs < 0:
+            return
+        lhs = text.rfind('$', 0, rhs)
+        if lhs < 0:
+            if rhs == 0:
+                raise TemplateFallback()
+        elif lhs + 1 == rhs:
+            raise TemplateFallback()
+
+    def child(self):
+        '''
+        Returns a new engine layered on top of this one, see layered.py
+
+        The child sees every macro of this engine, macros added to the child
+        are only seen by the child and hide macros of the same name here.
+        Nothing is copied, creating a child costs the same for any size table.
+        '''
+        # imported here, layered.py imports this module
+        from .layered import ChildMacroEngine
+        return ChildMacroEngine(self)
+
+    def freeze(self):
+        '''
+        Returns a FrozenMacroEngine, a read only snapshot of this engine
+
+        The snapshot can be shared by many threads without locks, see frozen.py
+        '''
+        # imported here, frozen.py imports this module
+        from .frozen import FrozenMacroEngine
+        self._check_environment()
+        return FrozenMacroEngine(self)
+
+    def save_snapshot(self, filename):
+        '''
+        Save the macros, their output order and resolved values to a binary file
+
+        Everything is resolved first, errors are raised. See load_snapshot()
+        and snapshot.py for the file format.
+        '''
+        self.cache_update()
+        order = self.emission().order
+        tmp = os.fspath(filename) + '.tmp'
+        # opened before the try, if this fails there is nothing to remove
+        f = open(tmp, 'wb')
+        try:
+            with f:
+                write_snapshot(f, self, order, self._resolved_values())
+        except BaseException:
+            # do not leave half a file behind
+            os.remove(tmp)
+            raise
+        # replace, so a reader never sees half a file
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load_snapshot(cls, filename):
+        '''
+        Create an engine from a file written by save_snapshot()
+
+        Nothing is resolved, the output order and resolved values are
+        taken from the file. Raises MacroSnapshotError if the file is not
+        a snapshot, or a snapshot of an unsupported (major) version.
+        '''
+        data = read_snapshot(filename)
+        e = cls()
+        e.use_env = data.use_env
+        e.ascii_check = data.ascii_check
+        e.resolver = data.resolver
+        entries = []
+        for name, value, eq_make, eq_bash, where, lineno, flags, resolved, depends in data.macros:
+            m = MacroEntry(name, value, validate=False)
+            # note: not yet in the table, nothing to tell about these
+            m._flags = flags
+            m._eq_make = eq_make
+            m._eq_bash = eq_bash
+            m.remember_where(where, lineno)
+            entries.append(m)
+        e.macros.add_entries(entries)
+        e._cache.put_many((x[0], x[7], x[8]) for x in data.macros if x[7] is not None)
+        e._dirty.clear()
+        if data.order is not None:
+            e._known_order = (e._version, data.order)
+        return e
 
     def get(self, name, default=None):
         '''
@@ -393,62 +1309,98 @@ class MacroEngine(object):
             m.references = []
 
         # Calculate all references
+        todo = []
         for name, m in self.macros.items():
             # if this macro has no value or is externaly defined...
             if (m.value is None) or m.external or m.env:
                 # consider the macro already present
                 result.append(name)
                 continue
-            r = self.resolve_text(m.value, self.RESOLVE_REFERENCES)
+            todo.append(m)
+        values = [m.value for m in todo]
+        for m, r in zip(todo, self.resolve_many(values, self.RESOLVE_REFERENCES)):
             m.references = r.references[:]
         # Ok each macro now has a list of what it depends upon
 
-        # Now, create our result
-        forward_progress = True
-        while True:
-            # are we done? If so stop
-            if len(result) == len(self.macros):
-                break;
-
-            # Get the list of names we need to
-            # Because MACROS is a DICT... the key order is quasi-random
-            # Thus, we sort the list of keys so that we evaulate things
-            # in fixed order and unit tests don't have to worry about
-            # quasi-random dict order
-            todo = sorted(self.macros.keys())
-
-            if not forward_progress:
-                # Problem, we did not make forward progress
-                raise MacroRecursionError('recursion involving macros: %s' % ' '.join(todo))
-
-            # Assume no progress
-            forward_progress = False
-            while len(todo):
-                # take one ...
-                name = todo.pop()
-                # if it is done already ...
-                if name in result:
-                    # Already did this one
-                    continue
-
-                # Assume this one is ok
-                ok = True
-                m = self.macros[name]
-                # for each macro this macro references
-                for r in reversed(m.references):
-                    # if this is not yet in the list
-                    if r.name not in result:
-                        ok = False
-                # was this one found?
-                if not ok:
-                    # nope, try another name
-                    continue
-                # Great we found one we are making progress
-                forward_progress = True
-                result.append(name)
+        if len(self.macros) != len(result) + len(todo):
+            # resolving found macros in the environment (and added them)
+            # these are already present, like those above
+            known = set(result)
+            known.update(m.name for m in todo)
+            for name in self.macros:
+                if name not in known:
+                    result.append(name)
+
+        # Build the graph, for each macro: the number of macros
+        # it still waits upon, and who waits upon each macro
+        done = set(result)
+        waiting = dict()
+        users = dict()
+        for m in todo:
+            need = set(r.name for r in m.references) - done
+            waiting[m.name] = len(need)
+            for dep in need:
+                users.setdefault(dep, []).append(m.name)
+
+        # Because MACROS is a DICT... the key order is quasi-random
+        # Thus, we work in reverse sorted order so that we evaulate things
+        # in fixed order and unit tests don't have to worry about
+        # quasi-random dict order.
+        #
+        # Think of it as sweeps over the names, each sweep in reverse sorted
+        # order. A macro that becomes ready during a sweep is done in this
+        # sweep if it comes after the current macro, else in the next sweep.
+        names = sorted(self.macros.keys())
+        rank = dict((name, idx) for idx, name in enumerate(names))
+        # heaps of -rank, so the largest name pops first
+        this_sweep = [-rank[name] for name, count in waiting.items() if count == 0]
+        heapq.heapify(this_sweep)
+        next_sweep = []
+        while len(this_sweep) or len(next_sweep):
+            if len(this_sweep) == 0:
+                this_sweep = next_sweep
+                next_sweep = []
+                heapq.heapify(this_sweep)
+            idx = -heapq.heappop(this_sweep)
+            name = names[idx]
+            result.append(name)
+            for user in users.get(name, ()):
+                waiting[user] -= 1
+                if waiting[user] == 0:
+                    if rank[user] < idx:
+                        heapq.heappush(this_sweep, -rank[user])
+                    else:
+                        next_sweep.append(-rank[user])
+
+        if len(result) != len(self.macros):
+            # Problem, we did not make forward progress
+            self._order_error(todo, set(result))
         # when done give our completed list.
         return result
 
+    def _order_error(self, todo, done):
+        # internal function
+        # output_order() could not order these macros, raise an error
+        # that says exactly which macros are involved in a loop
+        stuck = [m for m in todo if m.name not in done]
+        graph = dict()
+        for m in stuck:
+            graph[m.name] = sorted(set(r.name for r in m.references) - done)
+        loops = []
+        for scc in _strongly_connected(graph):
+            name = scc[0]
+            if (len(scc) > 1) or (name in graph[name]):
+                loops.append(' '.join(sorted(scc)))
+        if len(loops):
+            raise MacroRecursionError('recursion involving macros: %s' % ', '.join(sorted(loops)))
+        # no loop, something depends upon a macro we do not know about
+        unknown = []
+        for name in sorted(graph.keys()):
+            for dep in graph[name]:
+                if dep not in graph:
+                    unknown.append('%s (needs: %s)' % (name, dep))
+        raise MacroRecursionError('unknown macros referenced by: %s' % ', '.join(unknown))
+
     def output_array(self):
         '''Returns Macros as ordered array of dict, that describes each macro
 
@@ -465,8 +1417,36 @@ class MacroEngine(object):
         or a makfile might use:  FOO ?= BAR instead of FOO = BAR
 
         '''
+        return [dict(d) for d in self.emission().array]
+
+    def emission(self):
+        '''Returns a MacroEmission(), the macros ordered and resolved
+
+        This is what output_array() and the fragment functions are made from,
+        it is built once and reused until a macro changes. Thus writing the
+        macros in several formats costs about the same as writing one.
+        '''
+        self._check_environment()
+        if (self._emission is None) or (self._emission.version != self._version):
+            order = None
+            if (self._known_order is not None) and (self._known_order[0] == self._version):
+                order = self._known_order[1]
+            self._emission = self._build_emission(order, self._resolved_values())
+        return self._emission
+
+    def _resolved_values(self):
+        # internal function, the resolved value of every macro (a DependencyCache)
+        # or None if some are not known, see cache_update()
+        if len(self._dirty):
+            return None
+        return self._cache
+
+    def _build_emission(self, order=None, resolved=None):
+        # internal function, see emission()
+        # order and resolved (name -> resolved value) are calculated if not given
         aresult = []
-        order = self.output_order()
+        if order is None:
+            order = self.output_order()
         d = {
             'type': 'comment',
             'output': False,
@@ -485,30 +1465,29 @@ class MacroEngine(object):
         # if you are changing things entirely, bump FORMAT_MAJOR and reset FORMAT_MINOR
         assert( FORMAT_MAJOR == 1 )
         assert( FORMAT_MINOR == 0 )
+        if resolved is None:
+            # resolve every normal value as one batch
+            normal = [name for name in order if self._emit_type(self.macros[name]) is None]
+            resolved = dict()
+            for name, r in zip(normal, self.resolve_many([self.macros[name].value for name in normal])):
+                if not r.ok:
+                    raise r.error
+                resolved[name] = r.result
         for name in order:
             m = self.macros[name]
-            type = None
+            type = self._emit_type(m)
             value = m.value
             output = False
             comment = ''
-            if m.env:
-                type = 'env'
-                value = 'Unknown'
-            if m.external:
-                type = 'ext'
-                value = 'Unknown'
-            if (type is None) and (value is None):
-                type = 'novalue'
+            if type is not None:
                 value = 'Unknown'
-            if type is None:
+            else:
                 type = 'normal'
                 output = True
-                r = self.resolve_text(value)
-                if not r.ok:
-                    raise r.error
-                if r.result != value:
+                text = resolved[name]
+                if text != value:
                     comment = 'orig: %s=%s' % (m.name, m.value)
-                value = r.result
+                value = text
             d = {
                 'type': type,
                 'output': output,
@@ -518,11 +1497,22 @@ class MacroEngine(object):
                 'eq_make': m.eq_make,
                 'eq_bash': m.eq_bash}
             aresult.append(d)
-        return aresult
+        return MacroEmission(self._version, order, aresult)
+
+    def _emit_type(self, m):
+        # internal function
+        # the output type of a macro that is not output, or None for normal macros
+        if m.external:
+            return 'ext'
+        if m.env:
+            return 'env'
+        if m.value is None:
+            return 'novalue'
+        return None
 
     def bash_fragment_arr(self):
         '''Return the macros as a BASH friendly array of strings'''
-        aresult = self.output_array()
+        aresult = self.emission().array
         result = [
             '#',
             '# Generated by ShellMacros.py',
@@ -543,13 +1533,17 @@ class MacroEngine(object):
         '''Return a string form of bash_fragment_arr()'''
         return self._ascii_sanity_check('\n'.join(self.bash_fragment_arr()))
 
+    def write_bash_fragment(self, f):
+        '''Write bash_fragment_str() to the text file f, without building the string'''
+        self._write_checked(f, _joined_lines(self.bash_fragment_arr()))
+
     def make_fragment_arr(self):
         '''Return the macros as a GNU makefile friendly array of strings
 
         Nothing here that I know if is GNU makefile specific
         It should just work with other Unix makefiles... Your Milage May Very
         '''
-        aresult = self.output_array()
+        aresult = self.emission().array
         result = [
             '#',
             '# Generated by ShellMacros.py',
@@ -570,9 +1564,13 @@ class MacroEngine(object):
         '''returns a string form of make_fragment_arr()'''
         return self._ascii_sanity_check('\n'.join(self.make_fragment_arr()))
 
+    def write_make_fragment(self, f):
+        '''Write make_fragment_str() to the text file f, without building the string'''
+        self._write_checked(f, _joined_lines(self.make_fragment_arr()))
+
     def json_macros_str(self):
         '''Return the macros as a JSON string'''
-        aresult = self.output_array()
+        aresult = self.emission().array
         # NOTE: Human readablity in scripts is the reason we choose indent=4
         # Also, while technically this is an array...
         # we make it an object so that the JSON starts/ends with {} not []
@@ -580,22 +1578,39 @@ class MacroEngine(object):
         jstr = json.JSONEncoder(indent=4, sort_keys=True).encode(obj)
         return self._ascii_sanity_check(jstr)
 
+    def write_json_macros(self, f):
+        '''Write json_macros_str() to the text file f, without building the string'''
+        obj = { 'major' : FORMAT_MAJOR, 'minor' : FORMAT_MINOR, 'macros': self.emission().array}
+        self._write_checked(f, json.JSONEncoder(indent=4, sort_keys=True).iterencode(obj))
+
     def _ascii_sanity_check(self, s):
         # Generally build scripts are ASCII only, not unicode
         # This helps verify that the generated output is pure ascii
         if not self.ascii_check:
             return s
-        # This: https://stackoverflow.com/questions/196345/how-to-check-if-a-string-in-python-is-in-ascii
-        # talks about effiency, etc ...  We want a bit more of a restriction.
         # specifically we want:  (0x20 to 0x7e) - printable ascii
         # outside the printable range we only accept newline.
-        # the ASCII test, allows for other bytes we do not want to support
-        m = _non_ascii_regex.match(s)
-        # most likely case
-        if m is None:
-            return s
-        # something is wrong!
-        for (lineno, line) in enumerate(s.split('\n')):
-            m = _non_ascii_regex.match(s)
-            if m is not None:
-                raise MacroNonAsciiError('non-ascii in output, line: %d, text=%s' % (lineno + 1, line))
+        # see asciicheck.py
+        return check_ascii(s)
+
+    def _write_checked(self, f, pieces):
+        # internal function, write the pieces of text to f, see write_make_fragment()
+        # the pieces are gathered into large chunks, each chunk is checked before
+        # it is written so nothing after a non-ascii character is written
+        checker = AsciiChecker() if self.ascii_check else None
+        chunk = []
+        size = 0
+        for piece in pieces:
+            chunk.append(piece)
+            size += len(piece)
+            if size >= _WRITE_CHUNK:
+                self._write_chunk(f, checker, ''.join(chunk))
+                chunk = []
+                size = 0
+        self._write_chunk(f, checker, ''.join(chunk))
+
+    def _write_chunk(self, f, checker, text):
+        # internal function, see _write_checked()
+        if checker is not None:
+            checker.check(text)
+        f.write(text)
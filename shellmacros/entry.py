@@ -1,6 +1,7 @@
 import re
+import sys
 
-__all__ = [ 'MacroEntry' ]
+__all__ = [ 'MacroEntry', 'validate_names' ]
 
 
 from .exceptions import MacroBadNameError
@@ -11,6 +12,20 @@ valid_name = re.compile( r'[A-Za-z_][A-Z0-9]*')
 
 _counter = 0
 
+
+def validate_names(names):
+    '''Check a batch of names, raises MacroBadNameError for the first bad name'''
+    match = valid_name.match
+    for name in names:
+        if match(name) is None:
+            raise MacroBadNameError("bad-macro-name: %s" % name)
+
+# bits in MacroEntry._flags
+_KEEP = 0x01
+_EXTERNAL = 0x02
+_ENV = 0x04
+_QUOTED = 0x08
+
 class MacroEntry( object ):
     '''
     This represents one macro entry, a name and value
@@ -36,7 +51,14 @@ class MacroEntry( object ):
     Or may be marked as externally defined
     '''
     
+    # There can be a very large number of macros, slots (no per entry __dict__)
+    # the flags packed into one int and shared eq_* strings keep them small
+    __slots__ = ('_table', '_filename', '_lineno', '_order', 'name', '_value',
+                 '_flags', '_eq_make', '_eq_bash', 'references')
+
     def __init__( self, name, value= None, validate=True):
+        # the MacroTable holding this entry, told when this entry changes
+        self._table = None
         self._filename = None
         self._lineno = None
         # keep track of the order macros where created
@@ -52,7 +74,29 @@ class MacroEntry( object ):
             if valid_name.match( name ) is None:
                 raise MacroBadNameError("bad-macro-name: %s" % name )
 
-        self.value = value
+        self._value = value
+        # keep, external, env and quoted, see _KEEP etc
+        self._flags = 0
+        self._eq_make = '='
+        self._eq_bash = '='
+        self.references = ()
+        '''The macros this macro refers to, set by MacroEngine.output_order()'''
+
+    def _changed(self):
+        # something that effects how this macro resolves (or is output) has changed
+        if self._table is not None:
+            self._table.changed(self.name)
+
+    def _set_flag(self, bit, value):
+        # internal, set or clear one of the _flags bits
+        if value:
+            self._flags |= bit
+        else:
+            self._flags &= ~bit
+        self._changed()
+
+    @property
+    def value(self):
         '''The value of this macro. Note value can be None
        
         The Eclipse IDE provides many dynamic variables such as ${ECLIPSE_HOME}
@@ -60,7 +104,15 @@ class MacroEntry( object ):
         
         But for now, the variable could be None.
         '''
-        self.external = False
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self._changed()
+
+    @property
+    def external(self):
         '''This macro might not exist until a future time
         
         An example is the Eclipse dynamic variable: ${PROJECT_LOC} we do not know
@@ -68,7 +120,14 @@ class MacroEntry( object ):
         The value of this macro will change if things "move" so we treat
         this macro as a special case.
         '''
-        self.keep = False
+        return bool(self._flags & _EXTERNAL)
+
+    @external.setter
+    def external(self, value):
+        self._set_flag(_EXTERNAL, value)
+
+    @property
+    def keep(self):
         '''This macro is known, but we generally do not want to expand unless required.
         
         For example, when creating a Makefile, we might want "CC=${CROSS_COMPILE}gcc"
@@ -79,17 +138,50 @@ class MacroEntry( object ):
         for example we might want the ${CROSS_COMPILE} macro to be expanded by Make later
         and thus, the ${CC} macro would also be expanded later
         '''
-        self.env = False
+        return bool(self._flags & _KEEP)
+
+    @keep.setter
+    def keep(self, value):
+        self._set_flag(_KEEP, value)
+
+    @property
+    def quoted(self):
+        '''If true, when expanding always quote this'''
+        return bool(self._flags & _QUOTED)
+
+    @quoted.setter
+    def quoted(self, value):
+        self._set_flag(_QUOTED, value)
+
+    @property
+    def env(self):
         '''Is this a macro from the Environment Variables?'''
+        return bool(self._flags & _ENV)
+
+    @env.setter
+    def env(self, value):
+        self._set_flag(_ENV, value)
 
-        self.eq_make='='
+    @property
+    def eq_make(self):
         '''Type of equal sign to use for Makefile macros'''
+        return self._eq_make
 
-        self.eq_bash='='
+    @eq_make.setter
+    def eq_make(self, value):
+        # interned, every macro using := shares one string
+        self._eq_make = sys.intern(value)
+        self._changed()
+
+    @property
+    def eq_bash(self):
         '''Type of equal sign to use for Bash scripts'''
+        return self._eq_bash
 
-        self.quoted=False
-        '''If true, when expanding always quote this'''
+    @eq_bash.setter
+    def eq_bash(self, value):
+        self._eq_bash = sys.intern(value)
+        self._changed()
 
     def str_where(self):
         '''Return a string representing where the maro was defined'''
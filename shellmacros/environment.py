@@ -0,0 +1,70 @@
+'''
+Where environment macros come from, see MacroEngine.add_environment()
+
+An EnvironmentSnapshot is a copy of the environment taken when it is
+created, looking up a name is one dict lookup instead of os.getenv().
+The copy does not change unless refresh() is called, or track_changes
+is set in which case the engine calls refresh() before it resolves.
+
+Every change found by refresh() bumps the version, the engine compares
+the version against the one it last saw and updates the macros it
+imported from the environment.
+'''
+import os
+
+__all__ = ['EnvironmentSnapshot']
+
+
+class EnvironmentSnapshot(object):
+    '''
+    A copy of the environment (or of any name -> value dict)
+
+    :param environ: The variables, None means os.environ
+    :param track_changes: Should the engine look for changes each time it resolves?
+
+    Empty values are treated as not set.
+    '''
+
+    def __init__(self, environ=None, track_changes=False):
+        self._environ = environ
+        self.track_changes = track_changes
+        '''If True refresh() is called every time the engine resolves text
+        (which costs a copy of the environment each time)'''
+        self.version = 0
+        '''Bumped every time refresh() finds a change'''
+        self._values = self._read()
+
+    def _read(self):
+        # internal, copy the variables that have a value
+        environ = os.environ if self._environ is None else self._environ
+        return dict((name, value) for name, value in environ.items() if value)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def get(self, name, default=None):
+        '''The value of the variable, or default if not set'''
+        return self._values.get(name, default)
+
+    def names(self):
+        '''Return a list of variable names'''
+        return list(self._values.keys())
+
+    def refresh(self):
+        '''
+        Read the environment again
+
+        :return: list of names that where added, removed or changed
+        '''
+        values = self._read()
+        if values == self._values:
+            return []
+        old = self._values
+        changed = [name for name, value in values.items() if old.get(name) != value]
+        changed.extend(name for name in old if name not in values)
+        self._values = values
+        self.version += 1
+        return changed
@@ -1,5 +1,5 @@
 
-__all__ = [ 'MacroRecursionError', 'MacroUndefinedError','MacroSyntaxError','MacroBadNameError','MacroNonAsciiError']
+__all__ = [ 'MacroRecursionError', 'MacroUndefinedError','MacroSyntaxError','MacroBadNameError','MacroNonAsciiError','MacroSnapshotError']
 
 class MacroRecursionError(Exception):
     pass
@@ -16,3 +16,5 @@ class MacroBadNameError(Exception):
 class MacroNonAsciiError(Exception):
     pass
 
+class MacroSnapshotError(Exception):
+    pass
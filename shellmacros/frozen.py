@@ -0,0 +1,180 @@
+'''
+A read only snapshot of a MacroEngine, see MacroEngine.freeze()
+
+Resolving with a MacroEngine changes the engine as it goes (caches, the
+template cache order, macros imported from the environment) so an engine
+cannot be shared by several threads. A FrozenMacroEngine never changes
+after it is created, any number of threads can use it at the same time
+without locks or copies.
+'''
+from .engine import MacroEngine
+from .entry import MacroEntry
+from .environment import EnvironmentSnapshot
+from .template import compile_template
+
+__all__ = ['FrozenMacroEngine']
+
+
+class _FrozenTemplates(object):
+    # internal, stands in for the TemplateCache
+    # templates for every macro value are compiled up front, other
+    # text is compiled each time (nothing is ever added)
+    def __init__(self, texts):
+        self._templates = dict()
+        for text in texts:
+            if text not in self._templates:
+                self._templates[text] = compile_template(text)
+
+    def __len__(self):
+        return len(self._templates)
+
+    def compile(self, text, how):
+        try:
+            return self._templates[text]
+        except KeyError:
+            return compile_template(text)
+
+
+class _FrozenResolver(MacroEngine):
+    # internal, a MacroEngine that only reads, see FrozenMacroEngine
+    def __init__(self, engine):
+        MacroEngine.__init__(self, 0)
+        self.debug = False
+        self.use_env = engine.use_env
+        self.resolver = engine.resolver
+        self.history_level = engine.history_level
+        if engine.use_env:
+            # a copy, the environment of the engine may track changes
+            env = engine.environment
+            self.environment = EnvironmentSnapshot(None if env is None else env._values)
+        # copies, so changes to the original engine are not seen here
+        # note: a plain dict, not a MacroTable, nothing listens for changes
+        self.macros = dict()
+        for name, old in engine.macros.items():
+            m = MacroEntry(name, old.value, validate=False)
+            m.external = old.external
+            m.keep = old.keep
+            m.quoted = old.quoted
+            m.env = old.env
+            m.eq_make = old.eq_make
+            m.eq_bash = old.eq_bash
+            m.remember_where(old._filename, old._lineno)
+            self.macros[name] = m
+        self.transforms = dict(engine.transforms)
+        self._suffix_alts = dict(engine._suffix_alts)
+        self._variants = dict(engine._variants)
+        # suffix variant name -> macro, ie: foo_lc, foo_uc ...
+        # note: apart from the macros, the environment comes first, see _find_macro()
+        self._variant_macros = dict()
+        for name, (base, suffix) in self._variants.items():
+            self._variant_macros[name] = self.macros[base]
+        self.template_cache = _FrozenTemplates(
+            m.value for m in self.macros.values() if m.value is not None)
+
+    def _check_environment(self):
+        # internal function, the environment was copied by __init__() and never changes
+        pass
+
+    def _find_macro(self, name):
+        # internal function, same as MacroEngine._find_macro() but
+        # environment macros are not remembered
+        # the order is: name, env name, variant, env variant
+        m = self.macros.get(name, None)
+        if m is not None:
+            return m
+        if self.use_env:
+            m = self._env_macro(name)
+            if m is not None:
+                return m
+        m = self._variant_macros.get(name, None)
+        if (m is not None) or (not self.use_env):
+            return m
+        for suffix in self.transforms:
+            if name.endswith(suffix) and (len(name) > len(suffix)):
+                m = self._env_macro(name[:-len(suffix)])
+                if m is not None:
+                    return m
+        return None
+
+    def _env_macro(self, name):
+        # internal function, same as MacroEngine._env_macro() without adding the macro
+        e = self.environment.get(name, None)
+        if e is None:
+            return None
+        m = MacroEntry(name, e, validate=False)
+        m.env = True
+        return m
+
+    def _macro_value(self, m, name):
+        # internal function, same as MacroEngine._macro_value() but
+        # transformed values are not remembered (that would be a change)
+        if (m.value is None) or (m.name == name):
+            return MacroEngine._macro_value(self, m, name)
+        if m.env and (name not in self._variants):
+            # an env variant, the environment macro is not indexed here
+            # see _find_macro(), name is the macro name and one suffix
+            return self.transforms[name[len(m.name):]](m.value)
+        return self._transform(m, name)
+
+
+class FrozenMacroEngine(object):
+    '''
+    A read only snapshot of a MacroEngine, created by MacroEngine.freeze()
+
+    Changes to the original engine after freeze() are not seen here.
+    Every macro value is resolved (RESOLVE_NORMAL) when the snapshot is made,
+    see value(). Resolving other text works exactly like the engine.
+
+    This is safe to use from many threads at the same time.
+    '''
+    RESOLVE_NORMAL = MacroEngine.RESOLVE_NORMAL
+    RESOLVE_FULLY = MacroEngine.RESOLVE_FULLY
+    RESOLVE_REFERENCES = MacroEngine.RESOLVE_REFERENCES
+
+    def __init__(self, engine):
+        self._engine = _FrozenResolver(engine)
+        names = [name for name, m in self._engine.macros.items() if m.value is not None]
+        values = [self._engine.macros[name].value for name in names]
+        # name -> MacroResult of resolving the value of the macro
+        self._values = dict(zip(names, self._engine.resolve_many(values)))
+
+    def __len__(self):
+        return len(self._engine.macros)
+
+    def __contains__(self, name):
+        return name in self._engine.macros
+
+    def names(self):
+        '''Return a list of macro names'''
+        return list(self._engine.macros.keys())
+
+    def get(self, name, default=None):
+        '''Return the MacroEntry for this name, or default. Do not modify the entry'''
+        return self._engine.macros.get(name, default)
+
+    def value(self, name):
+        '''
+        Return the resolved value of a macro, as resolve_simple() would
+
+        Raises KeyError if the macro does not exist or has no value
+        '''
+        r = self._values[name]
+        if not r.ok:
+            raise r.error
+        return r.result
+
+    def resolve_text(self, text, how=RESOLVE_NORMAL):
+        '''Same as MacroEngine.resolve_text()'''
+        return self._engine.resolve_text(text, how)
+
+    def resolve_simple(self, text, how=RESOLVE_NORMAL):
+        '''Same as MacroEngine.resolve_simple()'''
+        return self._engine.resolve_simple(text, how)
+
+    def resolve_many(self, texts, how=RESOLVE_NORMAL, lazy=False):
+        '''Same as MacroEngine.resolve_many()'''
+        return self._engine.resolve_many(texts, how, lazy)
+
+    def resolve_lines(self, lines, how=RESOLVE_NORMAL, filename='<input>'):
+        '''Same as MacroEngine.resolve_lines()'''
+        return self._engine.resolve_lines(lines, how, filename)
@@ -0,0 +1,270 @@
+'''
+Counting what the engine does, see MacroEngine.instrumentation_enable()
+
+Nothing here is used unless instrumentation is enabled. Enabling it
+puts wrappers around a few engine methods, on that engine only (the
+instance, not the class), disabling it removes them again. Thus an engine
+without instrumentation runs exactly the same code as before.
+
+The wrappers call the on_*() methods of an Instrumentation, which count.
+To do something else (send the numbers somewhere, log slow resolves)
+subclass Instrumentation and override the on_*() methods.
+
+    stats = engine.instrumentation_enable()
+    ... build something ...
+    print(stats.report())
+
+Note: Instrumentation is not thread safe, nor is a MacroEngine.
+'''
+import time
+from collections import Counter
+
+from .template import TemplateFallback
+
+__all__ = ['Instrumentation', 'install', 'uninstall', 'PHASES']
+
+PHASES = ('resolve', 'cache_update', 'unresolve_text', 'output_order', 'emission')
+'''The phases timed, they nest: cache_update resolves, emission orders'''
+
+# engine method -> phase, see install()
+_PHASE_METHODS = (
+    ('cache_update', 'cache_update'),
+    ('unresolve_text', 'unresolve_text'),
+    ('output_order', 'output_order'),
+    ('_build_emission', 'emission'),
+)
+
+# the other methods wrapped, see install()
+_WRAPPED = ('_resolve', 'resolve_simple', '_resolve_pass', '_resolve_compiled',
+            '_find_macro', '_macro_value')
+
+
+class Instrumentation(object):
+    '''
+    Counters for one or more engines, see MacroEngine.instrumentation_enable()
+
+    Lookups (see _find_macro()) are counted by how the macro was found:
+    'name', 'env', 'variant', 'env_variant', 'undefined' or 'missing'
+    (undefined, and known to be so from an earlier lookup).
+    '''
+
+    def __init__(self, per_template=True):
+        self.per_template = per_template
+        '''Keep the count and time per text resolved? see on_resolve()'''
+        self.reset()
+
+    def reset(self):
+        '''Forget everything counted'''
+        self.resolves = 0
+        '''Number of texts resolved'''
+        self.failures = 0
+        '''Number of resolves that gave an error'''
+        self.passes = 0
+        '''Passes over the text, one per macro for RESOLVER_REFERENCE, one per text compiled'''
+        self.fallbacks = 0
+        '''Compiled resolves that had to be done again by the reference resolver'''
+        self.steps = 0
+        '''Macros replaced, see MacroResult.steps'''
+        self.lookups = Counter()
+        '''How macros were found, key: see above'''
+        self.transform_hits = 0
+        '''Suffix variants (${foo_uc}) whose value was already transformed'''
+        self.transform_misses = 0
+        '''Suffix variants that had to be transformed'''
+        self.expansions = Counter()
+        '''How often each macro was used, key: macro name'''
+        self.phase_time = Counter()
+        '''Seconds spent in each phase, see PHASES'''
+        self.phase_calls = Counter()
+        '''Times each phase was entered'''
+        self.templates = dict()
+        '''text -> [resolves, seconds], if per_template'''
+        self.template_cache_start = dict()
+        '''Template cache counters when counting started, key: the TemplateCache'''
+        self.template_cache_end = dict()
+        '''The counters when counting stopped, see on_disable()'''
+
+    def on_enable(self, engine):
+        '''Called when instrumentation is enabled on engine'''
+        cache = engine.template_cache
+        self.template_cache_start.setdefault(cache, (cache.hits, cache.misses))
+
+    def on_disable(self, engine):
+        '''Called when instrumentation is disabled on engine'''
+        cache = engine.template_cache
+        self.template_cache_end[cache] = (cache.hits, cache.misses)
+
+    def on_resolve(self, text, passes, seconds, result):
+        '''Called after resolving text, result is the MacroResult'''
+        self.resolves += 1
+        self.passes += passes
+        self.steps += result.steps
+        if not result.ok:
+            self.failures += 1
+        for m in result.references:
+            self.expansions[m.name] += 1
+        if self.per_template:
+            t = self.templates.get(text, None)
+            if t is None:
+                t = self.templates[text] = [0, 0.0]
+            t[0] += 1
+            t[1] += seconds
+
+    def on_fallback(self, text):
+        '''Called when the compiled resolver gives up on text'''
+        self.fallbacks += 1
+
+    def on_lookup(self, name, how):
+        '''Called for every macro lookup, how it was found: see above'''
+        self.lookups[how] += 1
+
+    def on_transform(self, name, hit):
+        '''Called for every suffix variant value, hit if already transformed'''
+        if hit:
+            self.transform_hits += 1
+        else:
+            self.transform_misses += 1
+
+    def on_phase(self, phase, seconds):
+        '''Called at the end of a phase, see PHASES'''
+        self.phase_calls[phase] += 1
+        self.phase_time[phase] += seconds
+
+    def template_cache_stats(self):
+        '''Returns (hits, misses) of the template caches while counting'''
+        hits = 0
+        misses = 0
+        for cache, (h0, m0) in self.template_cache_start.items():
+            h1, m1 = self.template_cache_end.get(cache, (cache.hits, cache.misses))
+            hits += h1 - h0
+            misses += m1 - m0
+        return hits, misses
+
+    def hottest_macros(self, top=10):
+        '''Returns [(name, count), ...] the macros used most'''
+        return self.expansions.most_common(top)
+
+    def hottest_templates(self, top=10):
+        '''Returns [(text, resolves, seconds), ...] the texts that took longest'''
+        found = sorted(self.templates.items(), key=lambda item: item[1][1], reverse=True)
+        return [(text, t[0], t[1]) for text, t in found[:top]]
+
+    def report(self, top=10):
+        '''Returns a summary, as text'''
+        lines = []
+        lines.append('resolves: %d, failed: %d, passes: %d, steps: %d, fallbacks: %d'
+                     % (self.resolves, self.failures, self.passes, self.steps, self.fallbacks))
+        if self.resolves:
+            lines.append('per resolve: %.2f passes, %.2f steps'
+                         % (self.passes / self.resolves, self.steps / self.resolves))
+        lookups = ', '.join('%s: %d' % item for item in sorted(self.lookups.items()))
+        lines.append('lookups: %d (%s)' % (sum(self.lookups.values()), lookups))
+        lines.append('transforms: %d cached, %d done' % (self.transform_hits, self.transform_misses))
+        hits, misses = self.template_cache_stats()
+        lines.append('template cache: %d hits, %d misses' % (hits, misses))
+        lines.append('phases (seconds, they nest):')
+        for phase in PHASES:
+            if self.phase_calls[phase]:
+                lines.append('  %-15s %10.6f  (%d calls)'
+                             % (phase, self.phase_time[phase], self.phase_calls[phase]))
+        if len(self.expansions):
+            lines.append('hottest macros:')
+            for name, count in self.hottest_macros(top):
+                lines.append('  %8d  %s' % (count, name))
+        if len(self.templates):
+            lines.append('slowest templates (total seconds):')
+            for text, count, seconds in self.hottest_templates(top):
+                if len(text) > 60:
+                    text = text[:57] + '...'
+                lines.append('  %10.6f  %6d  %s' % (seconds, count, text))
+        return '\n'.join(lines)
+
+
+def install(engine, instr):
+    '''Wrap the engine methods so they report to instr, see uninstall()'''
+    cls = type(engine)
+    clock = time.perf_counter
+    # passes made by the resolve in progress
+    passes = [0]
+
+    def _resolve(text, how, memo):
+        passes[0] = 0
+        start = clock()
+        result = cls._resolve(engine, text, how, memo)
+        seconds = clock() - start
+        instr.on_phase('resolve', seconds)
+        instr.on_resolve(text, passes[0], seconds, result)
+        return result
+
+    def resolve_simple(text, how=engine.RESOLVE_NORMAL):
+        # the same path as resolve_text(), so the resolve is seen
+        if '$' not in text:
+            return text
+        r = engine.resolve_text(text, how)
+        if not r.ok:
+            raise r.error
+        return r.result
+
+    def _resolve_pass(result, how):
+        passes[0] += 1
+        return cls._resolve_pass(engine, result, how)
+
+    def _resolve_compiled(result, how, memo=None):
+        passes[0] += 1
+        try:
+            return cls._resolve_compiled(engine, result, how, memo)
+        except TemplateFallback:
+            instr.on_fallback(result.original)
+            raise
+
+    def _find_macro(name):
+        missing = name in engine._missing
+        m = cls._find_macro(engine, name)
+        if m is None:
+            how = 'missing' if missing else 'undefined'
+        elif m.name != name:
+            how = 'env_variant' if m.env else 'variant'
+        else:
+            how = 'env' if m.env else 'name'
+        instr.on_lookup(name, how)
+        return m
+
+    def _macro_value(m, name):
+        if (m.name != name) and (m.value is not None):
+            instr.on_transform(name, name in engine._transformed)
+        return cls._macro_value(engine, m, name)
+
+    def timed(method, phase):
+        func = getattr(cls, method)
+
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return func(engine, *args, **kwargs)
+            finally:
+                instr.on_phase(phase, clock() - start)
+        return wrapper
+
+    wrappers = {
+        '_resolve': _resolve,
+        'resolve_simple': resolve_simple,
+        '_resolve_pass': _resolve_pass,
+        '_resolve_compiled': _resolve_compiled,
+        '_find_macro': _find_macro,
+        '_macro_value': _macro_value,
+    }
+    for method, phase in _PHASE_METHODS:
+        wrappers[method] = timed(method, phase)
+    uninstall(engine)
+    for method, func in wrappers.items():
+        setattr(engine, method, func)
+    instr.on_enable(engine)
+
+
+def uninstall(engine):
+    '''Remove what install() did'''
+    names = [method for method, phase in _PHASE_METHODS]
+    names.extend(_WRAPPED)
+    for method in names:
+        # the wrappers are instance attributes hiding the class methods
+        engine.__dict__.pop(method, None)
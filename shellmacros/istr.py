@@ -4,6 +4,11 @@ Created on Dec 27, 2019
 @author: duane
 
 '''
+try:
+    import numpy
+except ImportError:
+    # optional, see NumpyIStr and make_istr()
+    numpy = None
 
 DOLLAR = ord('$')
 LBRACE = ord('{')
@@ -17,70 +22,21 @@ class IStrFindResult(object):
     SYNTAX = 2
     def __init__(self):
         self.result = IStrFindResult.SYNTAX
+        self.code = IStrFindResult.SYNTAX
         self.lhs = 0
         self.rhs = 0
         self.name = None
 
-class IStr(list):
+class IStrBase(object):
     '''
-    This closely models a basic ASCII string
-    Note: Unicode strings are expressly not supported here.
-
-    The problem this addresses occurs during macro processing.
-    Sometimes macros are defined externally
-
-    Other times, macros are fully defined with a package.
-
-    Often macros need to be resolved either partially or fully
-
-    When a macro is only external - they get in the way of resolving other macros
-    To work around that, we convert the string into an array of integers
-
-    Then for every macro byte that is 'external' we add 0x100 
-    This makes the byte 'non-matchable'
+    What is common to every IStr backing store, see IStr
 
-    Later, when we convert the resolved string into we strip the 0x100.
+    A backing store provides: __len__, __getitem__ (the character with flags)
+    locate, mark, replace, sslice and __str__
     '''
 
     IGNORE = 0x100
 
-    def __init__(self, s):
-        '''
-        Constructor
-        '''
-        # convert to integers
-        list.__init__(self, map(ord, s))
-
-    def __str__(self):
-        # return as string, stripping flags
-        return ''.join(map(lambda v: chr(v & 0xff), self))
-
-    def sslice(self, lhs, rhs):
-        # return as string, stripping flags
-        return ''.join(map(lambda v: chr(v & 0xff), self[lhs:rhs]))
-
-    def iarray(self):
-        return self[:]
-
-    def mark(self, lhs, rhs, flagvalue=IGNORE):
-        '''
-        Apply flags to locations between left and right hand sides, ie: [lhs:rhs]
-        '''
-        for idx in range(lhs, rhs):
-            self[idx] |= flagvalue
-
-    def locate(self, needle, lhs, rhs):
-        '''Find this needle(char) in the hay stack(list).'''
-        try:
-            return self.index(needle, lhs, rhs)
-        except:
-            # not found
-            return -1
-
-    def replace(self, lhs, rhs, newcontent):
-        '''replace the data between [lhs:rhs] with newcontent'''
-        self[lhs: rhs] = map(ord, newcontent)
-
     def next_macro(self, lhs, rhs):
         '''
         Find a macro within the string, return (lhs,rhs) if found
@@ -151,14 +107,220 @@ class IStr(list):
         return result
 
 
-def test_istr():
+class IStr(IStrBase, list):
+    '''
+    This closely models a basic ASCII string
+    Note: Unicode strings are expressly not supported here.
+
+    The problem this addresses occurs during macro processing.
+    Sometimes macros are defined externally
+
+    Other times, macros are fully defined with a package.
+
+    Often macros need to be resolved either partially or fully
+
+    When a macro is only external - they get in the way of resolving other macros
+    To work around that, we convert the string into an array of integers
+
+    Then for every macro byte that is 'external' we add 0x100 
+    This makes the byte 'non-matchable'
+
+    Later, when we convert the resolved string into we strip the 0x100.
+    '''
+
+    IGNORE = 0x100
+
+    def __init__(self, s):
+        '''
+        Constructor
+        '''
+        # convert to integers
+        list.__init__(self, map(ord, s))
+
+    def __str__(self):
+        # return as string, stripping flags
+        return ''.join(map(lambda v: chr(v & 0xff), self))
+
+    def sslice(self, lhs, rhs):
+        # return as string, stripping flags
+        return ''.join(map(lambda v: chr(v & 0xff), self[lhs:rhs]))
+
+    def iarray(self):
+        return self[:]
+
+    def mark(self, lhs, rhs, flagvalue=IGNORE):
+        '''
+        Apply flags to locations between left and right hand sides, ie: [lhs:rhs]
+        '''
+        for idx in range(lhs, rhs):
+            self[idx] |= flagvalue
+
+    def locate(self, needle, lhs, rhs):
+        '''Find this needle(char) in the hay stack(list).'''
+        try:
+            return self.index(needle, lhs, rhs)
+        except:
+            # not found
+            return -1
+
+    def replace(self, lhs, rhs, newcontent):
+        '''replace the data between [lhs:rhs] with newcontent'''
+        self[lhs: rhs] = map(ord, newcontent)
+
+
+class CompactIStr(IStrBase):
+    '''
+    An IStr held as a bytearray of text and a bytearray of flags
+
+    This is the same as IStr(), but much smaller, each character is 2 bytes
+    rather then a Python int, and searching (locate) is done by bytearray.find()
+
+    Only latin-1 text can be held, see make_istr()
+    '''
+
+    def __init__(self, s):
+        self._text = bytearray(s.encode('latin-1'))
+        # 1 byte per char, the flags shifted down by 8 bits
+        self._flags = bytearray(len(self._text))
+
+    def __len__(self):
+        return len(self._text)
+
+    def __getitem__(self, idx):
+        return self._text[idx] | (self._flags[idx] << 8)
+
+    def __str__(self):
+        return self._text.decode('latin-1')
+
+    def sslice(self, lhs, rhs):
+        return self._text[lhs:rhs].decode('latin-1')
+
+    def iarray(self):
+        return [self[idx] for idx in range(len(self))]
+
+    def mark(self, lhs, rhs, flagvalue=IStrBase.IGNORE):
+        '''
+        Apply flags to locations between left and right hand sides, ie: [lhs:rhs]
+        '''
+        flag = flagvalue >> 8
+        flags = self._flags
+        if not any(flags[lhs:rhs]):
+            flags[lhs:rhs] = bytes((flag,)) * len(flags[lhs:rhs])
+            return
+        for idx in range(lhs, rhs):
+            flags[idx] |= flag
+
+    def locate(self, needle, lhs, rhs):
+        '''Find this needle(char) in the hay stack, flagged characters do not match'''
+        if needle > 0xff:
+            # a flagged needle, rare
+            for idx in range(lhs, min(rhs, len(self))):
+                if self[idx] == needle:
+                    return idx
+            return -1
+        while True:
+            idx = self._text.find(needle, lhs, rhs)
+            if (idx < 0) or (self._flags[idx] == 0):
+                return idx
+            lhs = idx + 1
+
+    def replace(self, lhs, rhs, newcontent):
+        '''replace the data between [lhs:rhs] with newcontent'''
+        newcontent = newcontent.encode('latin-1')
+        self._text[lhs:rhs] = newcontent
+        self._flags[lhs:rhs] = bytes(len(newcontent))
+
+
+class NumpyIStr(IStrBase):
+    '''
+    An IStr held as a NumPy array of 32bit integers, the character and flags
+
+    mark, locate and converting to a string are vectorized array operations.
+    Unlike CompactIStr any unicode text can be held, the flags are kept
+    above the unicode range (shifted up by FLAG_SHIFT bits).
+    Requires NumPy.
+    '''
+
+    FLAG_SHIFT = 16
+    # the bits holding the unicode character, the flags are above these
+    CHAR_MASK = 0x1fffff
+
+    def __init__(self, s):
+        if numpy is None:
+            raise ImportError("NumpyIStr requires numpy")
+        self._a = self._codes(s)
+
+    def _codes(self, s):
+        # the text as an array of unicode code points
+        return numpy.frombuffer(s.encode('utf-32-le'), dtype='<u4').astype(numpy.uint32)
+
+    def _strip(self, a):
+        # as a string, stripping flags
+        return (a & self.CHAR_MASK).astype('<u4').tobytes().decode('utf-32-le')
+
+    def __len__(self):
+        return len(self._a)
+
+    def __getitem__(self, idx):
+        # like IStr, the character with IGNORE (0x100) added if flagged
+        v = int(self._a[idx])
+        return (v & self.CHAR_MASK) | ((v & ~self.CHAR_MASK) >> self.FLAG_SHIFT)
+
+    def __str__(self):
+        return self._strip(self._a)
+
+    def sslice(self, lhs, rhs):
+        return self._strip(self._a[lhs:rhs])
+
+    def iarray(self):
+        a = self._a
+        flags = (a & numpy.uint32(~self.CHAR_MASK & 0xffffffff)) >> self.FLAG_SHIFT
+        return ((a & self.CHAR_MASK) | flags).tolist()
+
+    def mark(self, lhs, rhs, flagvalue=IStrBase.IGNORE):
+        '''
+        Apply flags to locations between left and right hand sides, ie: [lhs:rhs]
+        '''
+        self._a[lhs:rhs] |= (flagvalue << self.FLAG_SHIFT)
+
+    def locate(self, needle, lhs, rhs):
+        '''Find this needle(char) in the hay stack, flagged characters do not match'''
+        found = numpy.flatnonzero(self._a[lhs:rhs] == needle)
+        if len(found) == 0:
+            return -1
+        return lhs + int(found[0])
+
+    def replace(self, lhs, rhs, newcontent):
+        '''replace the data between [lhs:rhs] with newcontent'''
+        self._a = numpy.concatenate((self._a[:lhs], self._codes(newcontent), self._a[rhs:]))
+
+
+def make_istr(s):
+    '''Return the best IStr for this text
+
+    CompactIStr if the text is latin-1, otherwise NumpyIStr if NumPy is
+    installed, and if not the original list based IStr.
+    '''
+    try:
+        return CompactIStr(s)
+    except UnicodeEncodeError:
+        # outside of latin-1
+        if numpy is not None:
+            return NumpyIStr(s)
+        return IStr(s)
+
+
+def test_istr(cls=IStr):
     def check2(l, r, text, dut):
         print("----")
         print("Check (%d,%d)" % (l, r))
         print("s = %s" % str(dut))
         print("i = %s" % dut.iarray())
         result = dut.next_macro(0, len(dut))
-        if (result.lhs != l) or (result.rhs != r):
+        if l < 0:
+            # not found
+            assert (result.code == result.NOTFOUND)
+        elif (result.lhs != l) or (result.rhs != r):
             print("str = %s" % str(dut))
             print("int = %s" % dut.iarray())
             print("Error: (%d,%d) != (%d,%d)" % (l, r, result.lhs, result.rhs))
@@ -173,7 +335,7 @@ def test_istr():
             expected = s[l + 2:r - 1]
         else:
             expected = None
-        dut = IStr(s)
+        dut = cls(s)
         check2(l, r, expected, dut)
         st = str(dut)
         assert (st == s)
@@ -217,7 +379,7 @@ def test_istr():
     r = str(dut)
 
     assert (r == "abc${X}xyz")
-    dut = check2(3, 7, "${X}", dut)
+    dut = check2(3, 7, "X", dut)
     dut.replace(3, 7, "ABC")
     s = str(dut)
     r = "abcABCxyz"
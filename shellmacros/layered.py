@@ -0,0 +1,259 @@
+'''
+Layered engines, see MacroEngine.child()
+
+A child engine is a cheap overlay on a parent engine, much like a
+collections.ChainMap. Macros added to the child live in the child, every
+other lookup falls through to the parent. Creating a child copies nothing.
+
+For example, a large table of global macros and a child per compile step
+holding that step's ${@} and ${<}:
+
+    step = engine.child()
+    step.add_makefle_dynamic_vars()
+    step.macros['@'].value = 'foo.o'
+    step.macros['<'].value = 'foo.c'
+    step.resolve_text('${CC} -c ${<} -o ${@}', step.RESOLVE_FULLY)
+
+Note: step.macros['CC'] is the MacroEntry of the parent, changing it
+changes the parent. Add a macro to the child to change it only there.
+
+Values resolved by the parent (see cache_update()) are used by the child
+unless they depend on a macro the child hides. Changes to the parent are
+seen by the child, the child then forgets what it has resolved itself.
+'''
+from collections import ChainMap
+
+from .engine import MacroEngine
+from .table import MacroTable
+
+__all__ = ['LayeredMacroTable', 'ChildMacroEngine']
+
+
+class LayeredMacroTable(MacroTable):
+    '''
+    A MacroTable on top of another table, see ChildMacroEngine
+
+    The macros held here are the ones in the underlying dict, every other
+    lookup falls through to the parent table. Only macros held here can be
+    removed, iteration gives the parent macros first then those added here.
+    '''
+
+    def __init__(self, parent, listener=None, many_listener=None):
+        MacroTable.__init__(self, listener, many_listener)
+        self.parent = parent
+        '''The table below this one'''
+
+    def __missing__(self, name):
+        return self.parent[name]
+
+    def get(self, name, default=None):
+        m = dict.get(self, name, None)
+        if m is None:
+            return self.parent.get(name, default)
+        return m
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or (name in self.parent)
+
+    def __len__(self):
+        return len(self.parent) + sum(1 for name in dict.__iter__(self) if name not in self.parent)
+
+    def __iter__(self):
+        for name in self.parent:
+            yield name
+        for name in dict.__iter__(self):
+            if name not in self.parent:
+                yield name
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+    def local(self):
+        '''The names of the macros held in this layer'''
+        return list(dict.keys(self))
+
+    def clear(self):
+        '''Remove the macros held in this layer'''
+        for name in self.local():
+            del self[name]
+
+
+class _LayeredValues(object):
+    # internal, the resolved values seen by a child engine
+    # looks like the DependencyCache of a MacroEngine, see _resolved_values()
+    def __init__(self, engine):
+        self._engine = engine
+
+    def get(self, name, default=None):
+        found = _lookup(self._engine, name)
+        if found is None:
+            return default
+        return found[0]
+
+    def __contains__(self, name):
+        return _lookup(self._engine, name) is not None
+
+    def __getitem__(self, name):
+        found = _lookup(self._engine, name)
+        if found is None:
+            raise KeyError(name)
+        return found[0]
+
+    def depends(self, name):
+        return _lookup(self._engine, name)[1]
+
+
+def _lookup(engine, name):
+    # internal, (resolved value, depends) of name as seen by engine, or None
+    if name in engine._cache:
+        return engine._cache[name], engine._cache.depends(name)
+    if not isinstance(engine, ChildMacroEngine):
+        return None
+    found = _lookup(engine.parent, name)
+    if (found is None) or not engine._shadowed.isdisjoint(found[1]):
+        # not resolved below, or resolved with a macro hidden here
+        return None
+    return found
+
+
+def _resolved_users(engine, name):
+    # internal, names resolved by engine (or below it) using the macro name
+    users = set(engine._cache.users(name))
+    if isinstance(engine, ChildMacroEngine):
+        users.update(_resolved_users(engine.parent, name))
+    return users
+
+
+def _unresolved(engine):
+    # internal, macros (with a value) without a resolved value as seen by engine
+    names = set(engine._dirty)
+    if isinstance(engine, ChildMacroEngine):
+        names.update(_unresolved(engine.parent))
+        for name in engine._shadowed:
+            names.update(_resolved_users(engine.parent, name))
+    answer = set()
+    for name in names:
+        m = engine.macros.get(name, None)
+        if (m is not None) and (m.value is not None) and (_lookup(engine, name) is None):
+            answer.add(name)
+    return answer
+
+
+class ChildMacroEngine(MacroEngine):
+    '''
+    A MacroEngine layered on top of another, created by MacroEngine.child()
+
+    Settings (use_env, resolver etc) are copied from the parent when the
+    child is created, the compiled templates are shared with the parent.
+    Suffix transforms belong to the parent, see add_transform().
+    '''
+
+    def __init__(self, parent):
+        MacroEngine.__init__(self, 0)
+        self.parent = parent
+        '''The engine below this one'''
+        parent._check_environment()
+        self.debug = parent.debug
+        self.use_env = parent.use_env
+        self.environment = parent.environment
+        self._env_state = parent._env_state
+        self.ascii_check = parent.ascii_check
+        self.resolver = parent.resolver
+        self.history_level = parent.history_level
+        # templates do not depend on the macros, compile each text once for everyone
+        self.template_cache = parent.template_cache
+        self.macros = LayeredMacroTable(parent.macros, self._macro_changed, self._macros_changed)
+        # names that mean something else here than in the parent, see _shadow()
+        self._shadowed = set()
+        # the parent version last seen, see _sync_parent()
+        self._parent_version = None
+        self._sync_parent()
+
+    def _sync_parent(self):
+        # internal function, if the parent changed forget what was learned here
+        parent = self.parent
+        if isinstance(parent, ChildMacroEngine):
+            parent._sync_parent()
+        if parent._version == self._parent_version:
+            return
+        self._parent_version = parent._version
+        self.transforms = parent.transforms
+        self._suffix_alts = parent._suffix_alts
+        # variants of the macros held here, then those of the parent
+        self._variants = ChainMap(dict(), parent._variants)
+        local = self.macros.local()
+        for name in local:
+            self._index_name(name)
+        self._shadowed = set()
+        for name in local:
+            self._shadow(name)
+        self._transformed.clear()
+        self._cache.clear()
+        self._missing.clear()
+        self._dirty = dict.fromkeys(local)
+        self._version += 1
+
+    def _shadow(self, name):
+        # internal function, the macro name was added (or changed) here
+        # values the parent resolved with that name are not valid here,
+        # nor are those that used a suffix variant ${name_x} now found differently
+        parent = self.parent
+        self._shadowed.add(name)
+        self._shadowed.add(parent._variant_base(name))
+        for suffix in self.transforms:
+            v = parent._variants.get(name + suffix, None)
+            if v is not None:
+                self._shadowed.add(v[0])
+
+    def _macro_changed(self, name):
+        # internal function, see MacroEngine._macro_changed()
+        MacroEngine._macro_changed(self, name)
+        self._shadow(name)
+
+    def _macros_changed(self, names):
+        # internal function, see MacroEngine._macros_changed()
+        MacroEngine._macros_changed(self, names)
+        for name in names:
+            self._shadow(name)
+
+    def add_transform(self, suffix, func):
+        '''Not supported, add transforms to the parent'''
+        raise ValueError("add_transform(%r): add transforms to the parent engine" % suffix)
+
+    def _check_environment(self):
+        # internal function, called before resolving
+        # also notices changes to the parent
+        self.parent._check_environment()
+        self._sync_parent()
+        MacroEngine._check_environment(self)
+
+    def _macro_value(self, m, name):
+        # internal function, see MacroEngine._macro_value()
+        # a variant of a parent macro, found the same way as in the parent,
+        # is transformed (and remembered) by the parent
+        if ((m.name != name) and (name not in self._transformed)
+                and (name not in self._variants.maps[0])
+                and not dict.__contains__(self.macros, m.name)):
+            return self.parent._macro_value(m, name)
+        return MacroEngine._macro_value(self, m, name)
+
+    def _cache_dirty(self):
+        # internal function, see MacroEngine.cache_update()
+        # values the parent has resolved are used unless they depend on a macro held here
+        unresolved = _unresolved(self)
+        # in table order, so the error raised (if several macros fail)
+        # is the same every time, and the same as for one flat engine
+        self._dirty = dict.fromkeys(name for name in self.macros if name in unresolved)
+        MacroEngine._cache_dirty(self)
+
+    def _resolved_values(self):
+        # internal function, see MacroEngine._resolved_values()
+        if len(_unresolved(self)):
+            return None
+        return _LayeredValues(self)
@@ -0,0 +1,148 @@
+'''
+Read macros from files, see MacroEngine.load_json(), load_env_file() and load_make_fragment()
+
+These read what json_macros_str(), bash_fragment_str() and make_fragment_str()
+write, as well as simple hand written files, ie:
+
+    # a comment
+    export CROSS_COMPILE=arm-none-eabi-
+    CC=${CROSS_COMPILE}gcc
+
+The output functions write resolved values, but also write the original value
+as a comment ("# orig: CC=${CROSS_COMPILE}gcc"), when present the original
+value is used so the references to other macros are kept.
+'''
+import re
+
+from .entry import MacroEntry, validate_names
+from .exceptions import MacroSyntaxError
+
+__all__ = ['json_entries', 'env_file_entries', 'make_fragment_entries']
+
+# NAME=VALUE, with an optional "export "
+_env_regex = re.compile(r'^(?:export\s+)?([^=\s]+)=(.*)$')
+# NAME=VALUE, NAME:=VALUE, NAME ?= VALUE etc
+_make_regex = re.compile(r'^([^:?+!=\s]+)\s*(::=|:=|\?=|\+=|!=|=)\s*(.*)$')
+# see MacroEngine.output_array(), the comment with the original value
+_orig_comment = 'orig: '
+_orig_prefix = '# ' + _orig_comment
+
+
+def _unquote(s):
+    # undo _make_quoted()/_bash_quoted() in the engine
+    if (len(s) >= 2) and (s[0] == s[-1]) and (s[0] in '"\''):
+        quote = s[0]
+        s = s[1:-1]
+        if quote == '"':
+            s = s.replace(r'\"', '"').replace(r"\'", "'")
+    return s
+
+
+def _entries(names, values):
+    # internal, validate the names then create the entries
+    validate_names(names)
+    return [MacroEntry(name, value, validate=False) for name, value in zip(names, values)]
+
+
+def json_entries(macros):
+    '''
+    Return a list of MacroEntry() from the "macros" array of json_macros_str()
+
+    Environment macros and the generated comment are skipped.
+    '''
+    names = []
+    values = []
+    dicts = []
+    for d in macros:
+        type = d['type']
+        if type in ('comment', 'env'):
+            continue
+        value = d['value']
+        if type in ('ext', 'novalue'):
+            value = None
+        else:
+            orig = '%s%s=' % (_orig_comment, d['name'])
+            if d['comment'].startswith(orig):
+                value = d['comment'][len(orig):]
+        names.append(d['name'])
+        values.append(value)
+        dicts.append(d)
+    entries = _entries(names, values)
+    for m, d in zip(entries, dicts):
+        m.external = (d['type'] == 'ext')
+        m.eq_make = d.get('eq_make', '=')
+        m.eq_bash = d.get('eq_bash', '=')
+    return entries
+
+
+def _parse_lines(lines, filename, regex, what):
+    # internal, parse NAME=VALUE style lines
+    # returns a list of (name, operator, value, lineno)
+    found = []
+    orig = None
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if line.startswith(_orig_prefix):
+            # the value before it was resolved, for the next line
+            orig = line[len(_orig_prefix):].partition('=')
+            continue
+        if (line == '') or line.startswith('#'):
+            continue
+        m = regex.match(line)
+        if m is None:
+            raise MacroSyntaxError("%s:%d: not a %s: %s" % (filename, lineno, what, line))
+        if regex.groups == 3:
+            name, op, value = m.groups()
+        else:
+            name, value = m.groups()
+            op = '='
+        value = _unquote(value)
+        if (orig is not None) and (orig[0] == name):
+            value = orig[2]
+        orig = None
+        found.append((name, op, value, lineno))
+    return found
+
+
+def env_file_entries(lines, filename='<input>'):
+    '''
+    Return a list of MacroEntry() from the lines of a shell KEY=VALUE file
+
+    Blank lines and # comments are skipped, other lines must be NAME=VALUE,
+    an "export " prefix is allowed. Quoted values are unquoted.
+    '''
+    found = _parse_lines(lines, filename, _env_regex, 'NAME=VALUE')
+    entries = _entries([f[0] for f in found], [f[2] for f in found])
+    for m, f in zip(entries, found):
+        m.remember_where(filename, f[3])
+    return entries
+
+
+def make_fragment_entries(lines, filename='<input>'):
+    '''
+    Return a list of MacroEntry() from the lines of a makefile fragment
+
+    Only simple assignments are understood, NAME=VALUE, NAME:=VALUE etc.
+    The assignment operator becomes the eq_make of the macro, NAME+=VALUE
+    appends to an earlier NAME in the same file.
+    '''
+    found = _parse_lines(lines, filename, _make_regex, 'make assignment')
+    names = []
+    values = dict()
+    ops = dict()
+    where = dict()
+    for name, op, value, lineno in found:
+        if op == '+=':
+            if values.get(name):
+                value = values[name] + ' ' + value
+            op = ops.get(name, '=')
+        if name not in values:
+            names.append(name)
+        values[name] = value
+        ops[name] = op
+        where[name] = lineno
+    entries = _entries(names, [values[name] for name in names])
+    for m in entries:
+        m.eq_make = ops[m.name]
+        m.remember_where(filename, where[m.name])
+    return entries
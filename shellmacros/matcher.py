@@ -0,0 +1,115 @@
+'''
+Reverse lookup of macro values, used by MacroEngine.unresolve_text()
+
+Given the resolved value of every macro, find the macro whose value is
+the longest one present in some text. This is an Aho-Corasick automaton,
+all values are found in a single scan over the text.
+'''
+
+__all__ = ['ValueMatcher']
+
+
+class ValueMatcher(object):
+    '''
+    Finds the longest macro value present in some text.
+
+    Ties (same length) go to the first macro given, a value shared by
+    several macros belongs to the first of those macros.
+
+    Empty values are not matched, see empty.
+    '''
+
+    def __init__(self, pairs):
+        '''
+        :param pairs: iterable of (name, value) in order of preference
+        '''
+        self.patterns = []
+        '''The (name,value) pairs that can be matched'''
+        self.empty = None
+        '''The first (name,value) pair whose value is the empty string, or None'''
+        # per state: transitions (char -> state), failure link
+        # and the best pattern found when we reach this state
+        self._goto = [dict()]
+        self._fail = [0]
+        self._best = [None]
+        # per pattern, sort key: longest first, then first given
+        self._keys = []
+        seen = set()
+        for name, value in pairs:
+            if value == '':
+                if self.empty is None:
+                    self.empty = (name, value)
+                continue
+            if value in seen:
+                continue
+            seen.add(value)
+            self._insert(name, value)
+        self._link()
+
+    def _insert(self, name, value):
+        idx = len(self.patterns)
+        self.patterns.append((name, value))
+        self._keys.append((-len(value), idx))
+        state = 0
+        for ch in value:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append(dict())
+                self._fail.append(0)
+                self._best.append(None)
+                self._goto[state][ch] = nxt
+            state = nxt
+        self._best[state] = idx
+
+    def _better(self, a, b):
+        # the better of two pattern numbers, either may be None
+        if a is None:
+            return b
+        if b is None:
+            return a
+        if self._keys[a] < self._keys[b]:
+            return a
+        return b
+
+    def _link(self):
+        # breadth first, calculate the failure links
+        goto = self._goto
+        fail = self._fail
+        queue = list(goto[0].values())
+        for state in queue:
+            for ch, nxt in goto[state].items():
+                f = fail[state]
+                while (f != 0) and (ch not in goto[f]):
+                    f = fail[f]
+                f = goto[f].get(ch, 0)
+                if f == nxt:
+                    f = 0
+                fail[nxt] = f
+                queue.append(nxt)
+            # every pattern that ends here, includes those via the failure link
+            self._best[state] = self._better(self._best[state], self._best[fail[state]])
+
+    def best(self, text):
+        '''Return (name,value) of the best match in text, or None'''
+        goto = self._goto
+        fail = self._fail
+        best = self._best
+        keys = self._keys
+        state = 0
+        found = None
+        for ch in text:
+            while True:
+                nxt = goto[state].get(ch)
+                if nxt is not None:
+                    state = nxt
+                    break
+                if state == 0:
+                    break
+                state = fail[state]
+            b = best[state]
+            if (b is not None) and ((found is None) or (keys[b] < keys[found])):
+                found = b
+        if found is None:
+            return None
+        return self.patterns[found]
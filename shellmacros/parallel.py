@@ -0,0 +1,89 @@
+'''
+Helpers for MacroEngine.resolve_all(), resolving macros in other processes
+
+Each worker process is given a snapshot of the macro table once, when it
+starts. It then resolves chunks of macro names and sends back plain data
+(the text, the error and the names referenced) that the parent merges.
+
+Resolving one macro never changes another, so every chunk can be resolved
+on its own and in any order.
+'''
+from .entry import MacroEntry
+from .environment import EnvironmentSnapshot
+
+__all__ = ['engine_snapshot', 'engine_from_snapshot', 'resolve_chunk']
+
+# the engine in a worker process, see _worker_init()
+_engine = None
+
+
+def engine_snapshot(engine):
+    '''
+    Return a picklable snapshot of what resolving needs from an engine
+
+    This is the settings and the macros, not the caches.
+    '''
+    environ = None
+    if engine.use_env:
+        # the workers see the same environment as this engine
+        engine._check_environment()
+        environ = dict(engine.environment._values)
+    macros = []
+    for m in engine.macros.values():
+        macros.append((m.name, m.value, m.external, m.keep, m.quoted, m.env))
+    return {
+        'use_env': engine.use_env,
+        'environ': environ,
+        'resolver': engine.resolver,
+        'template_cache_size': engine.template_cache.size,
+        'transforms': list(engine.transforms.items()),
+        'macros': macros,
+    }
+
+
+def engine_from_snapshot(snapshot):
+    '''Create a new MacroEngine from engine_snapshot()'''
+    # imported here, the engine imports this module
+    from .engine import MacroEngine
+    e = MacroEngine(snapshot['template_cache_size'])
+    e.use_env = snapshot['use_env']
+    if snapshot['environ'] is not None:
+        e.environment = EnvironmentSnapshot(snapshot['environ'])
+    e.resolver = snapshot['resolver']
+    for suffix, func in snapshot['transforms']:
+        e.add_transform(suffix, func)
+    for name, value, external, keep, quoted, env in snapshot['macros']:
+        # note: some names (ie: "@") are not valid to add()
+        m = MacroEntry(name, value, validate=False)
+        m.external = external
+        m.keep = keep
+        m.quoted = quoted
+        m.env = env
+        e.macros[name] = m
+    return e
+
+
+def _worker_init(snapshot):
+    # internal, runs once in each worker process
+    global _engine
+    _engine = engine_from_snapshot(snapshot)
+
+
+def _worker_resolve(job):
+    # internal, resolve a chunk of macros in a worker process
+    # returns a list of (ok, text, error, referenced names), one per name
+    names, how = job
+    return resolve_chunk(_engine, names, how)
+
+
+def resolve_chunk(engine, names, how):
+    '''
+    Resolve the value of each named macro, see _worker_resolve()
+
+    This is also used when resolve_all() does the work in this process.
+    '''
+    values = [engine.macros[name].value for name in names]
+    answer = []
+    for r in engine.resolve_many(values, how, lazy=True):
+        answer.append((r.ok, r.result, r.error, [m.name for m in r.references]))
+    return answer
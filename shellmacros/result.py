@@ -8,7 +8,7 @@ Resolve the text the MacroResult() is the result of that resolution.
 '''
 
 from .exceptions import *
-from .istr import IStr
+from .istr import IStr, make_istr
 
 __all__ = ['MacroResult']
 
@@ -20,15 +20,37 @@ class MacroResult(object):
     '''
     IGNORE = IStr.IGNORE
 
-    def __init__(self, text_in):
+    # how much history is kept, see history
+    HISTORY_OFF = 0
+    HISTORY_ENDS = 1
+    HISTORY_FULL = 2
+
+    # many results are made, keep them small and quick to create
+    __slots__ = ('done', 'ok', 'original', 'steps', 'history_level', 'history',
+                 '_istr', '_text', 'error', 'keep', 'references', 'undefined')
+
+    def __init__(self, text_in, history=HISTORY_ENDS):
         self.done = ('$' not in text_in)
         '''Is this result complete/done'''
         self.ok = self.done
         '''If done, is this result good/ok?'''
-        self.history = [text_in]
-        '''What happened during the translations'''
-        self.istr = IStr( text_in )
-        '''This is the work in process string'''
+        self.original = text_in
+        '''The text that was resolved'''
+        self.steps = 0
+        '''How many macros have been replaced, see MAX_RECURSION'''
+        self.history_level = history
+        '''HISTORY_OFF, HISTORY_ENDS or HISTORY_FULL'''
+        self.history = [text_in] if history else []
+        '''What happened during the translations
+
+        HISTORY_OFF keeps nothing, HISTORY_ENDS the original text and the
+        final (or failing) text, HISTORY_FULL adds the text after each replacement.
+        '''
+        self._istr = None
+        self._text = None
+        if self.done:
+            # nothing to resolve
+            self._text = text_in
         self.error = None
         '''If an error occurs, this holds an Exception to throw'''
         self.keep = None
@@ -42,32 +64,54 @@ class MacroResult(object):
         See MacroEngine.resolve_text() for details
         '''
 
+    @property
+    def istr(self):
+        '''This is the work in process string, created on first use'''
+        if self._istr is None:
+            self._istr = make_istr( self.original )
+        return self._istr
+
+    @property
+    def text(self):
+        '''The work in process text, as it is now'''
+        if self._istr is None:
+            return self.original
+        return str(self._istr)
+
     @property
     def result(self):
         '''The result of the macro resolution as a string'''
-        if self.ok:
-            return str(self.istr)
-        else:
+        if not self.ok:
             return None
+        if self._text is not None:
+            return self._text
+        return str(self.istr)
 
     def next_macro(self):
         '''Find the next macro'''
         return self.istr.next_macro(0,len(self.istr))
 
-    def update_history(self, text):
+    def update_history(self):
         '''
-        Append to the translation history
+        Count one more replacement, and remember the text if HISTORY_FULL
         '''
-        if len(self.history) < MAX_RECURSION:
-            self.history.append(text)
+        self.steps += 1
+        if self.steps >= MAX_RECURSION:
+            # overflow
+            self.declare_recursion()
             return
-        # overflow
-        self.declare_recursion()
+        if self.history_level == self.HISTORY_FULL:
+            self.history.append(str(self.istr))
+
+    def _end_history(self, text):
+        # internal, remember where we finished (HISTORY_ENDS and HISTORY_FULL)
+        if self.history_level and (text != self.history[-1]):
+            self.history.append(text)
 
     def replace(self,lhs,rhs,value):
         '''Replace text between LHS and RHS with some value'''
         self.istr.replace(lhs,rhs,value)
-        self.update_history( str(self.istr) )
+        self.update_history()
 
     def mark(self,lhs,rhs,flagvalue=IGNORE):
         '''Mark this region as ignored or some other flag'''
@@ -78,26 +122,49 @@ class MacroResult(object):
         '''Declare a syntax error, we cannot go further'''
         self.ok = False
         self.done = True
-        self.error = MacroSyntaxError("syntax: %s -> %s" % (self.history[0], self.history[-1]))
+        text = self.text
+        self._end_history(text)
+        self.error = MacroSyntaxError("syntax: %s -> %s" % (self.original, text))
 
     def declare_recursion(self):
         '''Delcare a recursion error'''
         self.ok = False
         self.done = True
-        self.error = MacroRecursionError("Recursion start: %s, now: %s" % (self.history[0], str(self.istr)))
+        text = self.text
+        self._end_history(text)
+        self.error = MacroRecursionError("Recursion start: %s, now: %s" % (self.original, text))
 
     def declare_undefined(self,name, isext):
         '''Declare an undefined variable, we cannot go further'''
         self.ok = False
         self.done = True
-        s = "undefined: %s -> %s undefined: %s" % (self.history[0], self.history[-1], name)
+        text = self.text
+        self._end_history(text)
+        s = "undefined: %s -> %s undefined: %s" % (self.original, text, name)
         if isext:
             s = "external-" + s
         self.error = MacroUndefinedError(s)
 
-    def declare_success(self):
-        '''Declare success, we are done'''
+    def declare_novalue(self, name):
+        '''Declare a macro without a value, we cannot go further'''
+        self.ok = False
+        self.done = True
+        text = self.text
+        self._end_history(text)
+        s = "novalue: %s -> %s novalue: %s" % (self.original, text, name)
+        self.error = MacroUndefinedError(s)
+
+    def declare_success(self, text=None):
+        '''Declare success, we are done
+
+        If given, text is the final result (from the compiled resolver)
+        '''
         self.ok = True
         self.done = True
+        if text is None:
+            text = self.text
+        # the text no longer changes
+        self._text = text
+        self._end_history(text)
 
 
@@ -0,0 +1,217 @@
+'''
+Binary snapshots of a prepared engine, see MacroEngine.save_snapshot()
+
+A snapshot holds the macros, the output order and the resolved value of
+every macro, so loading one needs no resolving at all. The file is read
+through mmap, it is made of fixed size tables of unsigned 32bit numbers
+and one block of UTF-8 text holding every string once.
+
+Layout, all numbers little endian:
+
+    header      see _header below
+    strings     per string, the offset (in characters) where it ends in the text block
+    macros      per macro, _FIELDS numbers: see write_snapshot()
+    order       output order, as macro numbers
+    dep_ends    per macro, where its list ends in "deps"
+    deps        the names (string numbers) each resolved value depends on
+    text        every string, one after the other
+
+The header gives the offset and count of each table, so a reader can
+skip tables it does not know about (see SNAPSHOT_MINOR).
+'''
+import array
+import mmap
+import os
+import struct
+import sys
+
+from .exceptions import MacroSnapshotError
+
+__all__ = ['SNAPSHOT_MAJOR', 'SNAPSHOT_MINOR', 'SnapshotData', 'write_snapshot', 'read_snapshot']
+
+# NOTE:
+#   if the data here changes...
+#   YOU MUST CHANGE the SNAPSHOT_MAJOR and SNAPSHOT_MINOR
+# if you are adding more stuff (a new table), bump SNAPSHOT_MINOR
+# if you are changing things entirely, bump SNAPSHOT_MAJOR and reset SNAPSHOT_MINOR
+SNAPSHOT_MAJOR = 1
+SNAPSHOT_MINOR = 0
+
+_MAGIC = b'ShMacro\0'
+# magic, major, minor, engine flags, resolver, then (offset,count) for the 6 tables
+# counts are in numbers, or bytes for the text
+_header = struct.Struct('<8sHHII12I')
+_TABLES = ('strings', 'macros', 'order', 'dep_ends', 'deps', 'text')
+# numbers per macro
+_FIELDS = 8
+# "no string" or "no value"
+_NONE = 0xFFFFFFFF
+
+# engine flags
+_USE_ENV = 0x01
+_ASCII_CHECK = 0x02
+_HAS_ORDER = 0x04
+
+
+def _u32(values):
+    # an array of unsigned 32bit numbers, little endian
+    a = array.array('I', values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+class _Strings(object):
+    # internal, the string table of a snapshot being written
+    def __init__(self):
+        self.index = dict()
+        self.parts = []
+        self.ends = []
+        self.pos = 0
+
+    def add(self, s):
+        if s is None:
+            return _NONE
+        idx = self.index.get(s)
+        if idx is None:
+            idx = self.index[s] = len(self.parts)
+            self.parts.append(s)
+            self.pos += len(s)
+            self.ends.append(self.pos)
+        return idx
+
+
+def write_snapshot(f, engine, order, resolved=None):
+    '''
+    Write a snapshot of engine to the binary file f
+
+    :param order: The output order, or None if there is none
+    :param resolved: The resolved values (a DependencyCache) default: the engine cache
+    Every macro with a value must be resolved, see cache_update()
+    '''
+    if resolved is None:
+        resolved = engine._cache
+    strings = _Strings()
+    number = dict((name, idx) for idx, name in enumerate(engine.macros.keys()))
+    macros = []
+    dep_ends = []
+    deps = []
+    for name, m in engine.macros.items():
+        value = _NONE
+        if name in resolved:
+            value = strings.add(resolved[name])
+            deps.extend(strings.add(n) for n in resolved.depends(name))
+        dep_ends.append(len(deps))
+        lineno = _NONE if m._lineno is None else m._lineno
+        macros.extend((strings.add(name), strings.add(m.value), strings.add(m.eq_make),
+                       strings.add(m.eq_bash), strings.add(m._filename), lineno,
+                       m._flags, value))
+    flags = 0
+    if engine.use_env:
+        flags |= _USE_ENV
+    if engine.ascii_check:
+        flags |= _ASCII_CHECK
+    if order is not None:
+        flags |= _HAS_ORDER
+        order = [number[name] for name in order]
+    else:
+        order = []
+    tables = [_u32(strings.ends).tobytes(), _u32(macros).tobytes(), _u32(order).tobytes(),
+              _u32(dep_ends).tobytes(), _u32(deps).tobytes(),
+              ''.join(strings.parts).encode('utf-8', 'surrogatepass')]
+    counts = [len(strings.ends), len(macros), len(order), len(dep_ends), len(deps), len(tables[5])]
+    where = []
+    offset = _header.size
+    for data, count in zip(tables, counts):
+        where.extend((offset, count))
+        offset += len(data)
+    f.write(_header.pack(_MAGIC, SNAPSHOT_MAJOR, SNAPSHOT_MINOR, flags, engine.resolver, *where))
+    for data in tables:
+        f.write(data)
+
+
+class SnapshotData(object):
+    '''
+    The contents of a snapshot file, see read_snapshot()
+    '''
+
+    def __init__(self):
+        self.minor = 0
+        '''The SNAPSHOT_MINOR of the file'''
+        self.use_env = False
+        self.ascii_check = True
+        self.resolver = 0
+        self.macros = []
+        '''Per macro: (name, value, eq_make, eq_bash, filename, lineno, flags, resolved, depends)'''
+        self.order = None
+        '''The output order (names) or None'''
+
+
+def read_snapshot(filename):
+    '''Read a snapshot file, returns a SnapshotData()'''
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < _header.size:
+            raise MacroSnapshotError('%s: not a macro snapshot' % filename)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return _read(mm, filename)
+    except (struct.error, IndexError, KeyError, UnicodeDecodeError, ValueError) as e:
+        raise MacroSnapshotError('%s: damaged snapshot: %s' % (filename, e))
+    finally:
+        mm.close()
+
+
+def _read(mm, filename):
+    # internal, see read_snapshot()
+    fields = _header.unpack_from(mm, 0)
+    magic, major, minor, flags, resolver = fields[:5]
+    if magic != _MAGIC:
+        raise MacroSnapshotError('%s: not a macro snapshot' % filename)
+    if major != SNAPSHOT_MAJOR:
+        raise MacroSnapshotError('%s: unsupported snapshot version: %d.%d' % (filename, major, minor))
+    where = dict()
+    for idx, table in enumerate(_TABLES):
+        offset, count = fields[5 + idx * 2], fields[6 + idx * 2]
+        if table == 'text':
+            where[table] = bytes(mm[offset:offset + count])
+            if len(where[table]) != count:
+                raise ValueError('truncated')
+            continue
+        a = array.array('I')
+        a.frombytes(mm[offset:offset + count * 4])
+        if len(a) != count:
+            raise ValueError('truncated')
+        if sys.byteorder == 'big':
+            a.byteswap()
+        where[table] = a
+
+    # every string, decoded in one go
+    text = where['text'].decode('utf-8', 'surrogatepass')
+    ends = where['strings'].tolist()
+    strings = [text[start:end] for start, end in zip([0] + ends, ends)]
+    # so "no string" is None
+    strings_or_none = dict(enumerate(strings))
+    strings_or_none[_NONE] = None
+    string = strings_or_none.__getitem__
+
+    data = SnapshotData()
+    data.minor = minor
+    data.use_env = bool(flags & _USE_ENV)
+    data.ascii_check = bool(flags & _ASCII_CHECK)
+    data.resolver = resolver
+    table = where['macros'].tolist()
+    dep_ends = where['dep_ends'].tolist()
+    deps = [strings[n] for n in where['deps']]
+    if len(table) != len(dep_ends) * _FIELDS:
+        raise ValueError('bad macro table')
+    names = [strings[n] for n in table[0::_FIELDS]]
+    start = 0
+    for idx, end in enumerate(dep_ends):
+        rec = table[idx * _FIELDS:(idx + 1) * _FIELDS]
+        lineno = None if rec[5] == _NONE else rec[5]
+        data.macros.append((names[idx], string(rec[1]), strings[rec[2]], strings[rec[3]],
+                            string(rec[4]), lineno, rec[6], string(rec[7]), deps[start:end]))
+        start = end
+    if flags & _HAS_ORDER:
+        data.order = [names[idx] for idx in where['order']]
+    return data
@@ -0,0 +1,86 @@
+'''
+Helpers for MacroEngine.resolve_stream(), reading and writing files line by line
+
+Large inputs can be read through mmap, so the file is never read into memory
+as a whole, the operating system pages it in as we go.
+'''
+import io
+import mmap
+import os
+
+__all__ = ['read_lines', 'stream_name', 'MMAP_THRESHOLD']
+
+MMAP_THRESHOLD = 16 * 1024 * 1024
+'''Files larger then this (in bytes) are read via mmap, see read_lines()'''
+
+
+def stream_name(f, default='<stream>'):
+    '''The name of a file object, used in error messages'''
+    name = getattr(f, 'name', None)
+    if isinstance(name, str):
+        return name
+    return default
+
+
+def _mmap_lines(f, encoding):
+    # lines of an open binary file via mmap, from the current position
+    # afterwards the file is at the end, as if it was read
+    start = f.tell()
+    if os.fstat(f.fileno()).st_size <= start:
+        # nothing left, and mmap cannot map an empty file
+        return
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        mm.seek(start)
+        for line in iter(mm.readline, b''):
+            yield line.decode(encoding)
+        f.seek(mm.size())
+    finally:
+        mm.close()
+
+
+def _use_mmap(f, use_mmap):
+    # should this open file be read via mmap?
+    if isinstance(f, io.TextIOBase):
+        # text files are decoded (and newlines translated) by the file object
+        return False
+    if use_mmap is not None:
+        return use_mmap
+    try:
+        return os.fstat(f.fileno()).st_size > MMAP_THRESHOLD
+    except (AttributeError, OSError, ValueError):
+        # not a real file
+        return False
+
+
+def read_lines(infile, use_mmap=None, encoding='utf-8'):
+    '''
+    Generator, yields the lines of infile including the line ending
+
+    :param infile: A filename, or a file object opened for reading
+    :param use_mmap: True/False or None to decide based on file size (see MMAP_THRESHOLD)
+    :param encoding: Used to decode the file (when given a filename or using mmap)
+
+    Open files are read from their current position. Only filenames and
+    binary files are read via mmap, text files are read as they are
+    (ie: with their newline translation).
+    '''
+    if not isinstance(infile, (str, bytes, os.PathLike)):
+        # an open file
+        if _use_mmap(infile, use_mmap):
+            for line in _mmap_lines(infile, encoding):
+                yield line
+            return
+        for line in infile:
+            if isinstance(line, bytes):
+                line = line.decode(encoding)
+            yield line
+        return
+    with open(infile, 'rb') as f:
+        if _use_mmap(f, use_mmap):
+            for line in _mmap_lines(f, encoding):
+                yield line
+            return
+    with open(infile, 'r', encoding=encoding, newline='\n') as f:
+        for line in f:
+            yield line
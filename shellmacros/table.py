@@ -0,0 +1,93 @@
+'''
+The table of macros held by a MacroEngine
+
+This is a normal dict (name -> MacroEntry) that also tells the engine
+when a macro is added, removed or changed so cached results that depend
+on that macro can be thrown away.
+'''
+
+__all__ = ['MacroTable']
+
+
+class MacroTable(dict):
+    '''
+    A dict of MacroEntry()s, keyed by name, that reports changes
+
+    The listener is called with the macro name when a macro is added,
+    removed or when a MacroEntry in the table changes.
+
+    The many_listener (optional) is called with a list of names, when
+    many macros are added at once, see add_entries()
+    '''
+
+    def __init__(self, listener=None, many_listener=None):
+        dict.__init__(self)
+        self._listener = listener
+        self._many_listener = many_listener
+
+    def changed(self, name):
+        '''Report a change to this macro'''
+        if self._listener is not None:
+            self._listener(name)
+
+    def changed_many(self, names):
+        '''Report a change to all of these macros'''
+        if self._many_listener is not None:
+            self._many_listener(names)
+            return
+        for name in names:
+            self.changed(name)
+
+    def add_entries(self, entries):
+        '''Add (or replace) many MacroEntry()s, changes are reported once at the end'''
+        names = []
+        for entry in entries:
+            name = entry.name
+            old = dict.get(self, name, None)
+            if (old is not None) and (old is not entry):
+                old._table = None
+            dict.__setitem__(self, name, entry)
+            entry._table = self
+            names.append(name)
+        self.changed_many(names)
+        return names
+
+    def __setitem__(self, name, entry):
+        old = dict.get(self, name, None)
+        if (old is not None) and (old is not entry):
+            old._table = None
+        dict.__setitem__(self, name, entry)
+        entry._table = self
+        self.changed(name)
+
+    def __delitem__(self, name):
+        old = self[name]
+        dict.__delitem__(self, name)
+        old._table = None
+        self.changed(name)
+
+    def pop(self, name, *args):
+        if name not in self:
+            return dict.pop(self, name, *args)
+        old = self[name]
+        del self[name]
+        return old
+
+    def popitem(self):
+        name, old = dict.popitem(self)
+        old._table = None
+        self.changed(name)
+        return name, old
+
+    def setdefault(self, name, entry=None):
+        if name not in self:
+            self[name] = entry
+        return self[name]
+
+    def update(self, *args, **kwargs):
+        for name, entry in dict(*args, **kwargs).items():
+            self[name] = entry
+
+    def clear(self):
+        for name in list(self.keys()):
+            del self[name]
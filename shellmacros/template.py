@@ -0,0 +1,168 @@
+'''
+Compiled templates
+
+A template is text that has been tokenized once into literal text and
+macro references, for example:  "abc ${${a}_${b}} xyz" becomes:
+
+    [ 'abc ', Reference( [ Reference(['a']), '_', Reference(['b']) ] ), ' xyz' ]
+
+Literal text is held as a plain python string, a Reference holds the list
+of parts that make up the macro name (which may themselves be references)
+
+The MacroEngine walks this tree and resolves the text in one pass, rather
+then rescanning the entire string once for every macro it replaces.
+
+Only "regular" text is compiled, text the original one-macro-per-pass
+resolver might treat differently (a stray '}', a '$' inside a macro name,
+an unclosed '${') is rejected and the engine falls back to that resolver.
+'''
+import re
+from collections import OrderedDict
+
+__all__ = ['Template', 'Reference', 'TemplateCache', 'compile_template']
+
+DEFAULT_CACHE_SIZE = 1024
+
+# what we stop at while tokenizing
+_token_regex = re.compile(r'\$\{|\$|\}')
+
+
+class TemplateFallback(Exception):
+    '''
+    Internal, raised when the compiled resolver cannot guarantee the same
+    result as the reference resolver, the engine catches this and redoes
+    the work with the reference resolver.
+    '''
+    pass
+
+
+class Reference(object):
+    '''
+    This represents one ${name} reference within a template
+    '''
+
+    def __init__(self, parts):
+        self.parts = parts
+        '''The parts that make up the name, strings or nested references'''
+        self.name = None
+        '''If the name is simple text, ie: ${foo} - this is the name'''
+        if len(parts) == 1 and isinstance(parts[0], str):
+            self.name = parts[0]
+
+
+class Template(object):
+    '''
+    This is a compiled template, see compile_template()
+    '''
+
+    def __init__(self, text, parts):
+        self.text = text
+        '''The original text'''
+        self.parts = parts
+        '''The literal strings and Reference()s that make up this text'''
+
+
+def _append_text(parts, s):
+    # join adjacent literal text, ie: 'a' '$' 'b' becomes 'a$b'
+    if len(parts) and isinstance(parts[-1], str):
+        parts[-1] = parts[-1] + s
+    else:
+        parts.append(s)
+
+
+def compile_template(text):
+    '''
+    Tokenize text into a Template
+
+    Returns None if the text is not regular, see the module description.
+    '''
+    stack = [[]]
+    pos = 0
+    for m in _token_regex.finditer(text):
+        tok = m.group()
+        if m.start() > pos:
+            _append_text(stack[-1], text[pos:m.start()])
+        pos = m.end()
+        if tok == '${':
+            stack.append([])
+        elif tok == '}':
+            if len(stack) == 1:
+                # stray close
+                return None
+            parts = stack.pop()
+            if len(parts) == 0:
+                # ${} - the empty name
+                return None
+            stack[-1].append(Reference(parts))
+        else:
+            if len(stack) > 1:
+                # a lone dollar within a name, ie: ${a$b}
+                return None
+            _append_text(stack[-1], tok)
+    if len(stack) > 1:
+        # unclosed, ie: ${foo
+        return None
+    if pos < len(text):
+        _append_text(stack[0], text[pos:])
+    return Template(text, stack[0])
+
+
+class TemplateCache(object):
+    '''
+    A bounded LRU cache of compiled templates
+
+    Keyed by the text and the resolve mode, a repeated template (for example a
+    command line used for every file) is only tokenized once.
+    '''
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        '''Maximum number of templates held, 0 disables the cache'''
+        self.hits = 0
+        '''How many lookups found a compiled template'''
+        self.misses = 0
+        '''How many lookups had to compile the text'''
+        self.evictions = 0
+        '''How many templates where dropped to make room'''
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def resize(self, size):
+        '''Change the maximum size, evicting the oldest entries as needed'''
+        self.size = size
+        self._trim()
+
+    def clear(self):
+        '''Empty the cache, the counters are not reset'''
+        self._entries.clear()
+
+    def stats(self):
+        '''Return the cache counters as a dict'''
+        return {'size': self.size, 'entries': len(self._entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+    def compile(self, text, how):
+        '''Same as compile_template(text), but cached'''
+        key = (text, how)
+        try:
+            tpl = self._entries[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return tpl
+        self.misses += 1
+        # note: irregular text (None) is cached as well
+        tpl = compile_template(text)
+        if self.size > 0:
+            self._entries[key] = tpl
+            self._trim()
+        return tpl
+
+    def _trim(self):
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
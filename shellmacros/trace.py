@@ -0,0 +1,90 @@
+'''
+Debug tracing, see MacroEngine.debug_enable()
+
+An engine with debug set traces what it does to the 'shellmacros'
+logger at DEBUG level: each text resolved, each value cached by
+cache_update() and each replacement made by unresolve_text(). Nothing is
+formatted unless the logger is enabled for DEBUG, configure logging as
+usual to see it:
+
+    logging.basicConfig(level=logging.DEBUG)
+    engine.debug_enable()
+
+Writing every line can cost more than the work traced. A TraceBuffer
+keeps only the last N records in memory (unformatted) to be looked at
+after something went wrong:
+
+    trace = TraceBuffer(1000).attach()
+    engine.debug_enable()
+    try:
+        ... build something ...
+    except Exception:
+        trace.dump(sys.stderr)
+        raise
+'''
+import collections
+import logging
+
+__all__ = ['logger', 'TraceBuffer']
+
+logger = logging.getLogger('shellmacros')
+'''Where debug traces go'''
+
+
+class TraceBuffer(logging.Handler):
+    '''
+    A logging handler that keeps the last capacity records
+
+    Records are formatted only when asked for, see lines() and dump().
+    '''
+
+    def __init__(self, capacity=1000, level=logging.DEBUG):
+        logging.Handler.__init__(self, level)
+        self.records = collections.deque(maxlen=capacity)
+        '''The last records, oldest first'''
+        self.setFormatter(logging.Formatter('%(message)s'))
+        # (logger, level, propagate) before attach()
+        self._attached = None
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def attach(self, to=None, propagate=False):
+        '''
+        Add this handler to a logger (default: shellmacros.trace.logger), returns self
+
+        The logger level is set to DEBUG. Unless propagate is True the
+        records are not also passed on to the parent loggers (ie: written).
+        detach() undoes this.
+        '''
+        self.detach()
+        if to is None:
+            to = logger
+        self._attached = (to, to.level, to.propagate)
+        to.addHandler(self)
+        to.setLevel(logging.DEBUG)
+        to.propagate = propagate
+        return self
+
+    def detach(self):
+        '''Remove this handler from the logger it was attached to'''
+        if self._attached is None:
+            return
+        to, level, propagate = self._attached
+        to.removeHandler(self)
+        to.setLevel(level)
+        to.propagate = propagate
+        self._attached = None
+
+    def clear(self):
+        '''Forget the records kept'''
+        self.records.clear()
+
+    def lines(self):
+        '''Returns the records kept as a list of formatted lines'''
+        return [self.format(record) for record in self.records]
+
+    def dump(self, f):
+        '''Write the records kept to the file f, one per line'''
+        for line in self.lines():
+            f.write(line + '\n')
@@ -0,0 +1,29 @@
+import sys
+
+sys.path.insert(0,"..")
+import unittest
+
+from benchmarks import run, workloads
+
+class TestBenchmarks( unittest.TestCase ):
+    def test_ONE_small_run( self ):
+        # every workload and operation works, on a tiny table
+        answer = run.run_benchmarks(200, repeat=1)
+        self.assertEqual(len(answer['results']), len(workloads.WORKLOADS) * len(run.OPERATIONS))
+        for r in answer['results']:
+            self.assertNotIn('error', r)
+            self.assertEqual(r['n'], 200)
+        # compared with itself nothing is slower
+        lines = run.compare(answer, answer)
+        self.assertEqual(len(lines), len(answer['results']) + 1)
+        self.assertFalse([line for line in lines if line.endswith('SLOWER')])
+
+    def test_TWO_same_table( self ):
+        # the same seed gives the same table, runs can be compared
+        for name in workloads.WORKLOADS:
+            a = workloads.make_workload(name, 500)
+            b = workloads.make_workload(name, 500)
+            self.assertEqual((a.macros, a.texts), (b.macros, b.texts))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,12 @@
+import asyncio
+import io
+import os
+import pathlib
 import sys
+import tempfile
+import threading
 import unittest
+import unittest.mock
 
 sys.path.insert(0,"..")
 
@@ -152,6 +159,17 @@ class TestMacroEngine(unittest.TestCase):
         for x in range(0,len(r)):
             self.assertEqual( correct[x] , r[x] )
         # Done.
+    def test_E015_order_loops(self):
+        e = shellmacros.MacroEngine()
+        e.add('A', '${B}')
+        e.add('B', '${A}')
+        e.add('C', '${A}')
+        e.add('D', 'x${D}')
+        e.add('E', 'plain')
+        with self.assertRaises(shellmacros.MacroRecursionError) as cm:
+            e.output_order()
+        # C is stuck, but only because of the A/B loop
+        self.assertEqual(str(cm.exception), 'recursion involving macros: A B, D')
     def test_E020_make(self):
         e = self.order_test_setup()
         j = e.json_macros_str()
@@ -187,6 +205,757 @@ class TestMacroEngine(unittest.TestCase):
         print("BASH RESULT\n-----\n%s\n------\n" % s )
         print("")
 
-        
+    def test_E060_emission(self):
+        e = self.order_test_setup()
+        em = e.emission()
+        self.assertEqual(em.order, e.output_order())
+        # all formats share one emission
+        e.bash_fragment_str()
+        e.make_fragment_str()
+        e.json_macros_str()
+        self.assertIs(e.emission(), em)
+        # output_array() gives copies, changing them changes nothing
+        a = e.output_array()
+        self.assertEqual(a, em.array)
+        a[-1]['value'] = 'oops'
+        self.assertNotEqual(a, em.array)
+        # a change means a new emission
+        e.add('a_dogs_lunch', 'yummy')
+        em2 = e.emission()
+        self.assertIsNot(em2, em)
+        d = [d for d in em2.array if d['name'] == 'foo'][0]
+        self.assertEqual(d['value'], 'yummy')
+        self.assertIn('foo=yummy', e.bash_fragment_str())
+
+    def compare_resolvers(self, e, text, how):
+        # resolve text with both resolvers, they must agree exactly
+        e.resolver = e.RESOLVER_REFERENCE
+        r1 = e.resolve_text(text, how)
+        e.resolver = e.RESOLVER_COMPILED
+        r2 = e.resolve_text(text, how)
+        self.assertEqual(r1.ok, r2.ok)
+        self.assertEqual(r1.result, r2.result)
+        self.assertEqual(type(r1.error), type(r2.error))
+        self.assertEqual(str(r1.error), str(r2.error))
+        self.assertEqual(r1.references, r2.references)
+
+    def test_F010_compiled_vs_reference(self):
+        e = self.setup1()
+        e.add('A', '${B}')
+        e.add('B', '${A}')
+        e.add('dollar', '$')
+        e.add('close', 'x}')
+        e.add('paren', ')x')
+        texts = [
+            '', 'plain', '${parent}', '${${${parent}_son}_${what}}',
+            'abc ${EXTERN} xyz', '${keep} and ${keep}', '${${keep}}',
+            '${noclose', 'noopen}', '}abcd', '${a$b}', '$${pet} $$', '${}',
+            '${A}', '${undefined}', '${pet_uc} ${pet_lc}', 'a $) b',
+            '${dollar}{pet}', '${close} ${pet}', '${paren} (${pet})',
+            '${${dollar}}', ' '.join(['${pet}'] * 60),
+            ]
+        for how in (e.RESOLVE_NORMAL, e.RESOLVE_FULLY, e.RESOLVE_REFERENCES):
+            for text in texts:
+                self.compare_resolvers(e, text, how)
+
+    def test_F020_template_cache(self):
+        e = self.setup1()
+        e.set_template_cache_size(2)
+        for x in range(3):
+            r = e.resolve_text('${parent} ${what}')
+            self.assertEqual(r.result, 'duane dog')
+        stats = e.template_cache.stats()
+        # first time: the text and the value ${pet} are compiled
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hits'], 4)
+        self.assertEqual(stats['evictions'], 0)
+        # the same text resolved another way is another entry
+        r = e.resolve_text('${parent} ${what}', e.RESOLVE_FULLY)
+        self.assertEqual(r.result, 'duane dog')
+        self.assertEqual(e.template_cache.evictions, 2)
+        # no cache, same answer
+        e.set_template_cache_size(0)
+        self.assertEqual(len(e.template_cache), 0)
+        r = e.resolve_text('${parent} ${what}')
+        self.assertEqual(r.result, 'duane dog')
+
+    def check_cache(self, e):
+        # the incremental cache must match resolving everything from scratch
+        e.cache_update()
+        correct = dict()
+        for name, m in e.macros.items():
+            if m.value is not None:
+                correct[name] = e.resolve_simple(m.value)
+        self.assertEqual(dict(e._cache.items()), correct)
+
+    def test_G010_incremental_cache(self):
+        e = self.setup1()
+        e.add('pet_name', '${${parent}_son}_${pet}')
+        self.check_cache(e)
+        # only what depends on pet is redone
+        e.macros['pet'].value = 'cat'
+        self.assertEqual(sorted(e._dirty.keys()), ['pet', 'pet_name', 'what'])
+        self.check_cache(e)
+        self.assertEqual(e._cache['what'], 'cat')
+        e.mark_macro_keep('duane_son')
+        self.assertEqual(sorted(e._dirty.keys()), ['duane_son', 'pet_name'])
+        self.check_cache(e)
+        self.assertEqual(e._cache['pet_name'], '${duane_son}_cat')
+        e.mark_macro_external('pet')
+        self.check_cache(e)
+        e.add('pet', 'bird')
+        self.check_cache(e)
+        self.assertEqual(e._cache['what'], 'bird')
+        # adding a suffix variant changes what ${pet_uc} finds
+        e.add('x', '${pet_uc}')
+        self.check_cache(e)
+        self.assertEqual(e._cache['x'], 'BIRD')
+        e.add('pet_uc', 'fish')
+        self.check_cache(e)
+        self.assertEqual(e._cache['x'], 'fish')
+        del e.macros['pet_uc']
+        self.check_cache(e)
+        self.assertEqual(e._cache['x'], 'BIRD')
+        self.assertEqual(e.unresolve_text('duane BIRD'), '${parent} ${x}')
+
+    def test_G020_unresolve(self):
+        e = shellmacros.MacroEngine()
+        e.add('a', 'abc')
+        e.add('b', 'ab')
+        e.add('c', 'abc')
+        e.add('d', '${b}c')
+        # greedy, longest first, ties go to the first macro
+        self.assertEqual(e.unresolve_text('xabcx ab'), 'x${a}x ${b}')
+        matcher = e._matcher
+        self.assertEqual(e.unresolve_text('ab'), '${b}')
+        self.assertIs(e._matcher, matcher)
+        # the index is rebuilt when the table changes
+        e.add('e', 'xabc')
+        self.assertEqual(e.unresolve_text('xabcx ab'), '${e}x ${b}')
+        self.assertIsNot(e._matcher, matcher)
+        e.add('f', '')
+        with self.assertRaises(shellmacros.MacroRecursionError):
+            e.unresolve_text('ab')
+
+    def test_H010_resolve_many(self):
+        e = self.setup1()
+        texts = ['${what} ${pet_uc}', '${undefined}', '${${${parent}_son}_${what}}',
+                 '${keep} ${pet_uc}', '${what} ${pet_uc}']
+        results = e.resolve_many(texts)
+        self.assertEqual(len(results), len(texts))
+        for text, r in zip(texts, results):
+            r1 = e.resolve_text(text)
+            self.assertEqual(r.ok, r1.ok)
+            self.assertEqual(r.result, r1.result)
+            self.assertEqual(str(r.error), str(r1.error))
+            self.assertEqual(r.references, r1.references)
+        # a bad line has its own error
+        self.assertEqual(results[0].result, 'dog DOG')
+        self.assertIsInstance(results[1].error, shellmacros.MacroUndefinedError)
+        self.assertTrue(results[2].ok)
+        # lazy, changes made part way through are seen
+        results = e.resolve_many(texts, lazy=True)
+        self.assertEqual(next(results).result, 'dog DOG')
+        e.macros['pet'].value = 'cat'
+        next(results)
+        next(results)
+        self.assertEqual(next(results).result, '${keep} CAT')
+
+    def test_H020_resolve_stream(self):
+        e = self.setup1()
+        text = 'pet=${what}\nno macros\r\n${keep}\nlast ${parent}'
+        correct = 'pet=dog\nno macros\r\n${keep}\nlast duane'
+        with tempfile.TemporaryDirectory() as d:
+            fin = os.path.join(d, 'in.txt')
+            fout = os.path.join(d, 'out.txt')
+            with open(fin, 'w', newline='') as f:
+                f.write(text)
+            for use_mmap in (False, True):
+                self.assertEqual(e.resolve_stream(fin, fout, use_mmap=use_mmap), 4)
+                with open(fout, newline='') as f:
+                    self.assertEqual(f.read(), correct)
+            # errors say where
+            with open(fin, 'w') as f:
+                f.write('ok\n\n${parent} ${undefined}\n')
+            out = io.StringIO()
+            with self.assertRaises(shellmacros.MacroUndefinedError) as cm:
+                e.resolve_stream(fin, out)
+            self.assertEqual(str(cm.exception), '%s:3: undefined: ${parent} ${undefined} -> '
+                             'duane ${undefined} undefined: undefined' % fin)
+            self.assertEqual(out.getvalue(), 'ok\n\n')
+            # open files are read from where they are, text files as text
+            with open(fin, 'wb') as f:
+                f.write(b'head\r\nx ${pet}\r\n')
+            for use_mmap in (None, False, True):
+                for mode, correct in (('r', 'x dog\n'), ('rb', 'x dog\r\n')):
+                    with open(fin, mode) as f:
+                        f.readline()
+                        out = io.StringIO()
+                        e.resolve_stream(f, out, use_mmap=use_mmap)
+                        self.assertEqual(out.getvalue(), correct)
+
+    def test_H030_resolve_all(self):
+        e = self.setup1()
+        e.add_makefle_dynamic_vars()
+        e.add('cmd', '${pet_uc} -o ${@} ${keep}')
+        correct = dict()
+        for name, m in e.macros.items():
+            if m.value is not None:
+                correct[name] = e.resolve_text(m.value).result
+        for workers in (None, 2):
+            e.cache_reset()
+            r = e.resolve_all(workers=workers, chunk_size=3)
+            self.assertEqual(r, correct)
+            self.assertEqual(list(r.keys()), list(correct.keys()))
+        # the normal results are cached
+        self.assertEqual(e._cache['cmd'], 'DOG -o ${@} ${keep}')
+        e.add('pet', 'cat')
+        self.assertEqual(e.resolve_all(workers=2)['what'], 'cat')
+        # errors name the macro
+        e.add('broken', '${what} ${nothing}')
+        with self.assertRaises(shellmacros.MacroUndefinedError) as cm:
+            e.resolve_all(workers=2)
+        self.assertTrue(str(cm.exception).startswith('macro broken: undefined: '))
+
+    def test_H040_aresolve(self):
+        e = shellmacros.MacroEngine()
+        e.add_external('PROJECT_LOC')
+        e.add_external('HOME_DIR')
+        e.add_external('TOOLS')
+        e.add_external('NOBODY')
+        e.add('SRC', '${PROJECT_LOC}/src')
+        calls = []
+        busy = [0, 0]
+        async def provider(name):
+            calls.append(name)
+            busy[0] += 1
+            busy[1] = max(busy)
+            await asyncio.sleep(0.01)
+            busy[0] -= 1
+            return {'PROJECT_LOC': '${HOME_DIR}/proj', 'HOME_DIR': '/home/me',
+                    'TOOLS': '/opt/tools'}.get(name)
+        e.add_provider(provider)
+        text = '${SRC} ${TOOLS}'
+        # normal resolving keeps external macros
+        r = asyncio.run(e.aresolve_text(text))
+        self.assertEqual(r.result, '${PROJECT_LOC}/src ${TOOLS}')
+        self.assertEqual(calls, [])
+        r = asyncio.run(e.aresolve_text(text, e.RESOLVE_FULLY, concurrency=1))
+        self.assertEqual(r.result, '/home/me/proj/src /opt/tools')
+        self.assertEqual(sorted(calls), ['HOME_DIR', 'PROJECT_LOC', 'TOOLS'])
+        self.assertEqual(busy[1], 1)
+        # each value is only fetched once
+        r = asyncio.run(e.aresolve_text('${HOME_DIR} ${NOBODY}', e.RESOLVE_FULLY))
+        self.assertFalse(r.ok)
+        self.assertIsInstance(r.error, shellmacros.MacroUndefinedError)
+        asyncio.run(e.aresolve_text('${NOBODY}', e.RESOLVE_FULLY))
+        self.assertEqual(calls.count('HOME_DIR'), 1)
+        self.assertEqual(calls.count('NOBODY'), 1)
+        e.forget_fetched()
+        self.assertIsNone(e.macros['HOME_DIR'].value)
+
+    def test_H050_freeze(self):
+        e = self.setup1()
+        e.mark_macro_keep('zack_dog')
+        f = e.freeze()
+        texts = ['${${${parent}_son}_${what}}', '${pet_uc} ${keep}', '${EXTERN}', '${nothing}', 'abc']
+        correct = [e.resolve_text(t) for t in texts]
+        self.assertEqual(f.value('what'), 'dog')
+        self.assertEqual(f.value('EXTERN'), '${extern}')
+        with self.assertRaises(KeyError):
+            f.value('extern')
+        # changes to the engine do not change the snapshot
+        e.add('pet', 'cat')
+        self.assertEqual(f.value('what'), 'dog')
+        self.assertEqual(f.resolve_simple('${pet_uc}'), 'DOG')
+        # many threads, one snapshot
+        errors = []
+        def work():
+            for x in range(200):
+                for t, r in zip(texts, correct):
+                    r2 = f.resolve_text(t)
+                    if (r2.ok, r2.result, str(r2.error)) != (r.ok, r.result, str(r.error)):
+                        errors.append(t)
+        threads = [threading.Thread(target=work) for x in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_H051_freeze_environment(self):
+        # the snapshot finds macros in the same order as the engine:
+        # name, env name, suffix variant, env variant
+        environ = {'FOO_lc': 'fromenv', 'BAR': 'Bar', 'name': 'env'}
+        texts = ['${FOO_lc}', '${FOO_uc}', '${BAR} ${BAR_uc}', '${name} ${name_lc}', '${BAZ}', '${NOPE_lc}']
+        for resolver in (shellmacros.MacroEngine.RESOLVER_COMPILED, shellmacros.MacroEngine.RESOLVER_REFERENCE):
+            e = shellmacros.MacroEngine()
+            e.resolver = resolver
+            e.add('FOO', 'Base')
+            e.add('name', 'Mixed')
+            e.add('BAZ', '${BAR_lc}/${FOO_lc}')
+            e.add_environment(shellmacros.EnvironmentSnapshot(environ))
+            f = e.freeze()
+            c = e.child()
+            for t in texts:
+                r = e.resolve_text(t)
+                for other in (f, c):
+                    r2 = other.resolve_text(t)
+                    self.assertEqual((r2.ok, r2.result, str(r2.error)), (r.ok, r.result, str(r.error)))
+            self.assertEqual(f.resolve_simple('${FOO_lc}'), 'fromenv')
+            self.assertEqual(f.value('BAZ'), 'bar/fromenv')
+
+    def test_I010_entry(self):
+        e = self.order_test_setup()
+        m = e.add('CC', '${a}gcc')
+        # slots, no per entry dict
+        self.assertFalse(hasattr(m, '__dict__'))
+        with self.assertRaises(AttributeError):
+            m.color = 'red'
+        # the packed flags are independent of each other
+        m.keep = True
+        m.quoted = True
+        self.assertEqual((m.keep, m.external, m.env, m.quoted), (True, False, False, True))
+        m.keep = False
+        self.assertEqual((m.keep, m.external, m.env, m.quoted), (False, False, False, True))
+        m.quoted = False
+        # changing an equal sign is seen by the output
+        self.assertIn('CC=agcc', e.make_fragment_str())
+        m.eq_make = ''.join([':', '='])
+        self.assertIn('CC:=agcc', e.make_fragment_str())
+        # every macro shares one copy of the equal sign
+        n = e.add('LD', 'ld')
+        n.eq_make = ''.join([':', '='])
+        self.assertIs(n.eq_make, m.eq_make)
+
+    def test_I020_add_many(self):
+        e = self.setup1()
+        e.cache_update()
+        self.assertEqual(e._cache['what'], 'dog')
+        added = e.add_many({'pet': 'cat', 'tool': '${pet}_lc'})
+        self.assertEqual([m.name for m in added], ['pet', 'tool'])
+        e.add_many([('CC', 'gcc')], keep=True)
+        self.assertTrue(e.macros['CC'].keep)
+        # dependent cached values are thrown away
+        e.cache_update()
+        self.assertEqual(e._cache['what'], 'cat')
+        # a bad name, nothing is added
+        with self.assertRaises(shellmacros.MacroBadNameError):
+            e.add_many([('ok_name', 'x'), ('9bad', 'y')])
+        self.assertNotIn('ok_name', e.macros)
+
+    def test_I030_loaders(self):
+        e = shellmacros.MacroEngine()
+        e.add_keep('CC', '${CROSS_COMPILE}gcc')
+        e.add('CROSS_COMPILE', 'arm-none-eabi-')
+        e.add_external('WORKSPACE_LOC')
+        m = e.add('SOMEDIR', 'C:/path with/"spaces"')
+        m.eq_make = ':='
+        e.add('cmd', '${CC} -I${WORKSPACE_LOC}/foo -I${SOMEDIR}')
+        for text, load in ((e.json_macros_str(), 'load_json'),
+                           (e.bash_fragment_str(), 'load_env_file'),
+                           (e.make_fragment_str(), 'load_make_fragment')):
+            f = shellmacros.MacroEngine()
+            getattr(f, load)(io.StringIO(text))
+            # the original values are loaded, not the resolved values
+            for name in ('CC', 'CROSS_COMPILE', 'SOMEDIR', 'cmd'):
+                self.assertEqual(f.macros[name].value, e.macros[name].value)
+            if load == 'load_json':
+                self.assertTrue(f.macros['WORKSPACE_LOC'].external)
+            if load != 'load_env_file':
+                self.assertEqual(f.macros['SOMEDIR'].eq_make, ':=')
+        # hand written files
+        with tempfile.TemporaryDirectory() as d:
+            fname = os.path.join(d, 'vars.env')
+            with open(fname, 'w') as f:
+                f.write("# comment\n\nexport A='single quoted'\nB=${A}/b\n")
+            e = shellmacros.MacroEngine()
+            e.load_env_file(fname)
+            self.assertEqual(e.resolve_simple('${B}'), 'single quoted/b')
+            self.assertEqual(e.macros['B'].str_where(), '%s:4' % fname)
+            with open(fname, 'w') as f:
+                f.write("A := 1\nA += 2\nB ?= x\nthis is not make\n")
+            with self.assertRaises(shellmacros.MacroSyntaxError) as cm:
+                e.load_make_fragment(fname)
+            self.assertTrue(str(cm.exception).startswith('%s:4: ' % fname))
+        e = shellmacros.MacroEngine()
+        e.load_make_fragment(io.StringIO("A := 1\nA += 2\nB ?= x\n"))
+        self.assertEqual(e.macros['A'].value, '1 2')
+        self.assertEqual(e.macros['A'].eq_make, ':=')
+        self.assertEqual(e.macros['B'].eq_make, '?=')
+
+    def test_I040_snapshot(self):
+        e = shellmacros.MacroEngine()
+        e.add_keep('CC', '${CROSS_COMPILE}gcc')
+        e.add('CROSS_COMPILE', 'arm-none-eabi-')
+        e.add_external('WORKSPACE_LOC')
+        m = e.add('SOMEDIR', 'C:/path with/spaces')
+        m.eq_make = ':='
+        m.quoted = True
+        e.add_makefle_dynamic_vars()
+        e.add('cmd', '${CC} -I${WORKSPACE_LOC}/foo -I${SOMEDIR} -o ${@}')
+        e.add('nothing', None)
+        with tempfile.TemporaryDirectory() as d:
+            fname = os.path.join(d, 'macros.snap')
+            e.save_snapshot(fname)
+            f = shellmacros.MacroEngine.load_snapshot(fname)
+            self.assertEqual(list(f.macros.keys()), list(e.macros.keys()))
+            for name, m in e.macros.items():
+                m2 = f.macros[name]
+                self.assertEqual((m2.value, m2.keep, m2.external, m2.quoted, m2.eq_make),
+                                 (m.value, m.keep, m.external, m.quoted, m.eq_make))
+            # nothing is resolved, the output comes from the file
+            self.assertEqual(len(f._dirty), 0)
+            self.assertEqual(f.make_fragment_str(), e.make_fragment_str())
+            self.assertEqual(f.json_macros_str(), e.json_macros_str())
+            # the loaded cache knows what depends on what
+            f.add('CROSS_COMPILE', 'x86-')
+            f.cache_update()
+            self.assertEqual(f._cache['cmd'], '${CC} -I${WORKSPACE_LOC}/foo -I"C:/path with/spaces" -o ${@}')
+            self.assertEqual(f.resolve_simple('${CC}', f.RESOLVE_FULLY), 'x86-gcc')
+            # not a snapshot, or a future major version
+            with open(fname, 'r+b') as fp:
+                fp.seek(8)
+                fp.write(b'\x63\x00')
+            with self.assertRaises(shellmacros.MacroSnapshotError) as cm:
+                shellmacros.MacroEngine.load_snapshot(fname)
+            self.assertIn('unsupported snapshot version: 99.0', str(cm.exception))
+            with open(fname, 'wb') as fp:
+                fp.write(b'#\n' * 100)
+            with self.assertRaises(shellmacros.MacroSnapshotError):
+                shellmacros.MacroEngine.load_snapshot(fname)
+            # a pathlib.Path will do, and a failed save leaves nothing behind
+            path = pathlib.Path(d) / 'path.snap'
+            e.save_snapshot(path)
+            self.assertEqual(shellmacros.MacroEngine.load_snapshot(path).json_macros_str(), e.json_macros_str())
+            with unittest.mock.patch('shellmacros.engine.write_snapshot', side_effect=OSError('disk full')):
+                with self.assertRaises(OSError):
+                    e.save_snapshot(os.path.join(d, 'failed.snap'))
+            self.assertEqual(sorted(os.listdir(d)), ['macros.snap', 'path.snap'])
+            # the error is the one from open(), not from cleaning up
+            os.mkdir(os.path.join(d, 'dir.snap.tmp'))
+            with unittest.mock.patch('shellmacros.engine.os.remove') as remove:
+                with self.assertRaises(OSError):
+                    e.save_snapshot(os.path.join(d, 'dir.snap'))
+            remove.assert_not_called()
+
+    def test_J010_transforms(self):
+        e = shellmacros.MacroEngine()
+        e.add('src', 'C:/work/Main.c')
+        calls = []
+        def basename(value):
+            calls.append(value)
+            return value.replace('\\', '/').split('/')[-1]
+        e.add_transform('_basename', basename)
+        e.add_transform('_q', lambda value: "'%s'" % value)
+        self.assertEqual(e.resolve_simple('${src_basename} ${src_q} ${src_uc}'),
+                         "Main.c 'C:/work/Main.c' C:/WORK/MAIN.C")
+        # transformed once, until the macro changes
+        e.resolve_simple('${src_basename}')
+        self.assertEqual(calls, ['C:/work/Main.c'])
+        e.add('src', 'D:/other.c')
+        self.assertEqual(e.resolve_simple('${src_basename}'), 'other.c')
+        self.assertEqual(len(calls), 2)
+        # a real macro wins over a suffix variant
+        e.add('src_q', 'quoted')
+        self.assertEqual(e.resolve_simple('${src_q}'), 'quoted')
+        del e.macros['src_q']
+        self.assertEqual(e.resolve_simple('${src_q}'), "'D:/other.c'")
+        # variants go away with the macro
+        del e.macros['src']
+        r = e.resolve_text('${src_lc}')
+        self.assertIsInstance(r.error, shellmacros.MacroUndefinedError)
+        # the first suffix added wins, foo_y_x is ${foo} with suffix _y_x
+        # (even with foo_y defined), only once foo is gone is it ${foo_y} with suffix _x
+        e = shellmacros.MacroEngine()
+        e.add_transform('_y_x', lambda value: 'yx:' + value)
+        e.add_transform('_x', lambda value: 'x:' + value)
+        e.add('foo', 'F')
+        self.assertEqual(e.resolve_simple('${foo_y_x}'), 'yx:F')
+        e.add('foo_y', 'FY')
+        self.assertEqual(e.resolve_simple('${foo_y_x}'), 'yx:F')
+        del e.macros['foo']
+        self.assertEqual(e.resolve_simple('${foo_y_x}'), 'x:FY')
+        self.assertEqual(e.freeze().resolve_simple('${foo_y_x}'), 'x:FY')
+
+    def test_J020_environment(self):
+        environ = {'TOOLS': '/opt/Tools', 'EMPTY': ''}
+        e = shellmacros.MacroEngine()
+        e.add('name', 'Mixed')
+        e.add_environment(shellmacros.EnvironmentSnapshot(environ))
+        self.assertEqual(e.resolve_simple('${TOOLS}/bin'), '/opt/Tools/bin')
+        # found once, then it is a macro
+        self.assertTrue(e.macros['TOOLS'].env)
+        # suffix variants of macros and of the environment
+        self.assertEqual(e.resolve_simple('${name_lc}'), 'mixed')
+        self.assertEqual(e.resolve_simple('${TOOLS_uc}'), '/OPT/TOOLS')
+        # empty is not set
+        r = e.resolve_text('${EMPTY}')
+        self.assertIsInstance(r.error, shellmacros.MacroUndefinedError)
+        # misses are remembered, until a macro changes
+        r = e.resolve_text('${NOPE}')
+        self.assertIsInstance(r.error, shellmacros.MacroUndefinedError)
+        self.assertIn('NOPE', e._missing)
+        e.add('NOPE', 'yes')
+        self.assertEqual(e.resolve_simple('${NOPE_uc}'), 'YES')
+        # a snapshot does not change
+        environ['TOOLS'] = '/usr'
+        environ['LATER'] = 'later'
+        self.assertEqual(e.resolve_simple('${TOOLS}'), '/opt/Tools')
+        r = e.resolve_text('${LATER}')
+        self.assertIsInstance(r.error, shellmacros.MacroUndefinedError)
+        # unless refreshed
+        self.assertEqual(sorted(e.environment.refresh()), ['LATER', 'TOOLS'])
+        self.assertEqual(e.resolve_simple('${TOOLS} ${LATER}'), '/usr later')
+        # or changes are tracked
+        env = shellmacros.EnvironmentSnapshot(environ, track_changes=True)
+        e.add_environment(env)
+        e.cache_update()
+        self.assertEqual(e._cache['TOOLS'], '/usr')
+        environ['TOOLS'] = '/tools'
+        del environ['LATER']
+        self.assertEqual(e.resolve_simple('${TOOLS}'), '/tools')
+        self.assertEqual(env.version, 1)
+        self.assertNotIn('LATER', e.macros)
+        e.cache_update()
+        self.assertEqual(e._cache['TOOLS'], '/tools')
+        # os.environ by default
+        os.environ['SHELLMACROS_TEST'] = 'from env'
+        try:
+            e = shellmacros.MacroEngine()
+            e.add_environment()
+            self.assertEqual(e.resolve_simple('${SHELLMACROS_TEST}'), 'from env')
+            self.assertEqual(e.freeze().resolve_simple('${SHELLMACROS_TEST_uc}'), 'FROM ENV')
+            self.assertEqual(e.resolve_all()['SHELLMACROS_TEST'], 'from env')
+        finally:
+            del os.environ['SHELLMACROS_TEST']
+
+    def test_J021_environment_output(self):
+        # macros found in the environment while ordering are output too
+        for emit in ('output_order', 'make_fragment_str', 'bash_fragment_str', 'json_macros_str'):
+            e = shellmacros.MacroEngine()
+            e.add_environment(shellmacros.EnvironmentSnapshot({'HOME': '/h'}))
+            e.add('A', '${HOME}/x')
+            getattr(e, emit)()
+            self.assertEqual(e.output_order(), ['HOME', 'A'])
+            self.assertIn('A=/h/x', e.bash_fragment_str())
+
+    def test_J022_environment_tracked_output(self):
+        # with changes tracked the output follows the environment, nothing resolved in between
+        environ = {'HOME': '/h'}
+        e = shellmacros.MacroEngine()
+        e.add_environment(shellmacros.EnvironmentSnapshot(environ, track_changes=True))
+        e.add('A', '${HOME}/x')
+        step = e.child()
+        self.assertIn('\nA=/h/x', e.make_fragment_str())
+        self.assertIn('\nA=/h/x', step.make_fragment_str())
+        environ['HOME'] = '/home'
+        self.assertIn('\nA=/home/x', e.make_fragment_str())
+        self.assertIn('\nA=/home/x', step.make_fragment_str())
+        environ['HOME'] = '/root'
+        e.cache_update()
+        self.assertEqual(e._cache['A'], '/root/x')
+        self.assertEqual(step.freeze().value('A'), '/root/x')
+
+    def test_J030_child(self):
+        e = shellmacros.MacroEngine()
+        e.add_makefle_dynamic_vars()
+        e.add('CROSS_COMPILE', 'arm-none-eabi-')
+        e.add('CC', '${CROSS_COMPILE}gcc')
+        e.add('CFLAGS', '-O2')
+        e.add('compile', '${CC} ${CFLAGS} -c ${<} -o ${@}')
+        e.cache_update()
+        step = e.child()
+        self.assertIsInstance(step, shellmacros.ChildMacroEngine)
+        step.add_makefle_dynamic_vars()
+        step.macros['@'].value = 'foo.o'
+        step.macros['<'].value = 'foo.c'
+        self.assertEqual(step.resolve_simple('${compile}', step.RESOLVE_FULLY),
+                         'arm-none-eabi-gcc -O2 -c foo.c -o foo.o')
+        # the parent is not changed
+        self.assertIsNone(e.macros['@'].value)
+        self.assertEqual(len(step.macros), len(e.macros))
+        self.assertEqual(step.macros.local(), list('@%<?^+|*'))
+        # values resolved by the parent are used, unless a macro is hidden
+        step.add('CROSS_COMPILE', 'x86_64-')
+        step.cache_update()
+        self.assertEqual(sorted(step._cache.keys()), ['<', '@', 'CC', 'CROSS_COMPILE', 'compile'])
+        self.assertIn('compile', step._cache.users('CROSS_COMPILE'))
+        self.assertEqual(step.get('CC').value, '${CROSS_COMPILE}gcc')
+        lines = step.make_fragment_str()
+        self.assertIn('CC=x86_64-gcc', lines)
+        self.assertIn('CFLAGS=-O2', lines)
+        self.assertIn('CC=arm-none-eabi-gcc', e.make_fragment_str())
+        # suffix variants and layers of layers
+        inner = step.child()
+        inner.add('CFLAGS', '-g')
+        self.assertEqual(inner.resolve_simple('${CC_uc} ${CFLAGS}'), 'x86_64-GCC -g')
+        # changes to the parent are seen
+        e.add('CFLAGS', '-Os')
+        self.assertEqual(step.resolve_simple('${CFLAGS} ${CC}'), '-Os x86_64-gcc')
+        self.assertEqual(inner.resolve_simple('${CFLAGS} ${CC}'), '-g x86_64-gcc')
+        # only macros of the child can be removed
+        with self.assertRaises(KeyError):
+            del step.macros['CC']
+        del step.macros['CROSS_COMPILE']
+        step.cache_update()
+        self.assertEqual(step._resolved_values()['compile'], 'arm-none-eabi-gcc -Os -c ${<} -o ${@}')
+        with self.assertRaises(ValueError):
+            step.add_transform('_x', str.upper)
+
+    def test_J031_child_errors(self):
+        # when several macros fail, the first in the table is the error
+        # whatever the hash seed, the same as for one engine
+        flat = shellmacros.MacroEngine()
+        e = shellmacros.MacroEngine()
+        for x in (flat, e):
+            for n in range(20):
+                x.add('ok%d' % n, 'v%d' % n)
+            x.add('A', '${NOPE}')
+            x.add('B', 'x${B}')
+        c = e.child()
+        c.add('C', '${A}')
+        flat.add('C', '${A}')
+        for x in (flat, c):
+            with self.assertRaises(shellmacros.MacroUndefinedError) as cm:
+                x.cache_update()
+            self.assertEqual(str(cm.exception), 'undefined: ${NOPE} -> ${NOPE} undefined: NOPE')
+
+    def test_J040_ascii(self):
+        from shellmacros.asciicheck import AsciiChecker, check_ascii
+        self.assertEqual(check_ascii('ok\n ~fine\n'), 'ok\n ~fine\n')
+        # anywhere in the text, not just the first character
+        for text, where in (('abc\u00e9', 'line: 1, column: 4,'),
+                            ('a\nb\nab\tc', 'line: 3, column: 3,'),
+                            ('\x7f', 'line: 1, column: 1,')):
+            with self.assertRaises(shellmacros.MacroNonAsciiError) as cm:
+                check_ascii(text)
+            self.assertIn(where, str(cm.exception))
+        # in chunks, which may split lines
+        c = AsciiChecker()
+        c.check('one\ntw')
+        c.check('o, ')
+        with self.assertRaises(shellmacros.MacroNonAsciiError) as cm:
+            c.check('th\u00e9e\nfour')
+        self.assertEqual(str(cm.exception), 'non-ascii in output, line: 2, column: 8, text=two, th\u00e9e')
+        # the engine output, as a string or written as it is made
+        e = self.order_test_setup()
+        for func, write in ((e.bash_fragment_str, e.write_bash_fragment),
+                            (e.make_fragment_str, e.write_make_fragment),
+                            (e.json_macros_str, e.write_json_macros)):
+            f = io.StringIO()
+            write(f)
+            self.assertEqual(f.getvalue(), func())
+        e.add('menu', 'caf\u00e9')
+        with self.assertRaises(shellmacros.MacroNonAsciiError) as cm:
+            e.make_fragment_str()
+        self.assertIn('text=menu=caf\u00e9', str(cm.exception))
+        with self.assertRaises(shellmacros.MacroNonAsciiError):
+            e.write_bash_fragment(io.StringIO())
+        # JSON escapes it
+        self.assertIn('caf\\u00e9', e.json_macros_str())
+        e.disable_ascii_check()
+        self.assertIn('caf\u00e9', e.bash_fragment_str())
+
+    def test_J050_history(self):
+        e = self.setup1()
+        for resolver in (e.RESOLVER_COMPILED, e.RESOLVER_REFERENCE):
+            e.resolver = resolver
+            # the default, where we started and where we ended
+            r = e.resolve_text('${what}')
+            self.assertEqual(r.history, ['${what}', 'dog'])
+            self.assertEqual(r.steps, 2)
+            e.history_level = shellmacros.MacroResult.HISTORY_OFF
+            r = e.resolve_text('${what}')
+            self.assertEqual((r.result, r.history, r.original), ('dog', [], '${what}'))
+            e.history_level = shellmacros.MacroResult.HISTORY_FULL
+            r = e.resolve_text('${what}')
+            if resolver == e.RESOLVER_REFERENCE:
+                self.assertEqual(r.history, ['${what}', '${pet}', 'dog'])
+            else:
+                self.assertEqual(r.history, ['${what}', 'dog'])
+            e.history_level = shellmacros.MacroResult.HISTORY_ENDS
+            # errors name where it stopped, whatever the history level
+            r = e.resolve_text('${what} ${nope}')
+            self.assertEqual(str(r.error), 'undefined: ${what} ${nope} -> dog ${nope} undefined: nope')
+            self.assertEqual(r.history, ['${what} ${nope}', 'dog ${nope}'])
+        # recursion is found by counting replacements
+        e.add('A', 'a${B}')
+        e.add('B', '${A}')
+        e.history_level = shellmacros.MacroResult.HISTORY_OFF
+        r = e.resolve_text('${A}')
+        self.assertIsInstance(r.error, shellmacros.MacroRecursionError)
+        self.assertEqual(r.steps, shellmacros.result.MAX_RECURSION)
+        self.assertEqual(r.history, [])
+
+    def test_J060_resolve_simple(self):
+        e = self.setup1()
+        for resolver in (e.RESOLVER_COMPILED, e.RESOLVER_REFERENCE):
+            e.resolver = resolver
+            # nothing to resolve, the same string comes back
+            text = 'gcc -c foo.c'
+            self.assertIs(e.resolve_simple(text), text)
+            self.assertEqual(e.resolve_simple('a ${what} b'), 'a dog b')
+            self.assertEqual(e.resolve_simple('${pet_uc}'), 'DOG')
+            # errors are raised, with the same text as resolve_text()
+            with self.assertRaises(shellmacros.MacroUndefinedError) as cm:
+                e.resolve_simple('${what} ${nope}')
+            self.assertEqual(str(cm.exception), str(e.resolve_text('${what} ${nope}').error))
+        # results are small, see MacroResult.__slots__
+        r = e.resolve_text('${what}')
+        with self.assertRaises(AttributeError):
+            r.extra = 1
+
+    def test_J070_instrumentation(self):
+        e = self.setup1()
+        plain = set(vars(e))
+        stats = e.instrumentation_enable()
+        self.assertIs(e.instrumentation, stats)
+        for resolver in (e.RESOLVER_COMPILED, e.RESOLVER_REFERENCE):
+            e.resolver = resolver
+            e.resolve_text('${what} ${pet_uc}')
+        self.assertEqual(e.resolve_simple('${parent}'), 'duane')
+        e.resolve_text('${nope}')
+        self.assertEqual(stats.resolves, 4)
+        self.assertEqual(stats.failures, 1)
+        # compiled: 1 pass, reference: 1 per macro replaced plus the last
+        self.assertEqual(stats.passes, 1 + 4 + 2 + 1)
+        self.assertEqual(stats.hottest_macros(1), [('pet', 4)])
+        self.assertEqual(stats.lookups['variant'], 2)
+        self.assertEqual((stats.transform_misses, stats.transform_hits), (1, 1))
+        e.bash_fragment_str()
+        self.assertEqual(stats.phase_calls['emission'], 1)
+        self.assertIn('hottest macros:', stats.report())
+        # nothing is left behind
+        self.assertIs(e.instrumentation_disable(), stats)
+        self.assertEqual(set(vars(e)), plain)
+        resolves = stats.resolves
+        e.resolve_text('${what}')
+        self.assertEqual(stats.resolves, resolves)
+
+    def test_J080_trace(self):
+        e = self.setup1()
+        trace = shellmacros.TraceBuffer(3).attach()
+        try:
+            # nothing unless debug is enabled
+            e.resolve_simple('${what}')
+            self.assertEqual(len(trace.records), 0)
+            e.debug_enable()
+            self.assertEqual(e.resolve_simple('${what}'), 'dog')
+            e.resolve_text('${nope}')
+            self.assertEqual(trace.lines(), ['resolve: ${what} -> dog (2 steps)',
+                                             'resolve: ${nope} -> error: undefined: ${nope} -> ${nope} undefined: nope'])
+            # only the last few are kept
+            self.assertEqual(e.unresolve_text('a duane'), 'a ${parent}')
+            self.assertEqual(len(trace.records), 3)
+            self.assertEqual(trace.lines()[-1], 'unresolve: done, result: a ${parent}')
+            out = io.StringIO()
+            trace.dump(out)
+            self.assertEqual(out.getvalue().count('\n'), 3)
+        finally:
+            trace.detach()
+        self.assertNotIn(trace, shellmacros.trace.logger.handlers)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,9 +5,71 @@ import unittest
 
 import shellmacros
 
+BACKENDS = [shellmacros.istr.IStr, shellmacros.istr.CompactIStr]
+if shellmacros.istr.numpy is not None:
+    BACKENDS.append(shellmacros.istr.NumpyIStr)
+
 class TestISTR( unittest.TestCase ):
     def test_ONE( self ):
-        shellmacros.istr.test_istr
+        for cls in BACKENDS:
+            shellmacros.istr.test_istr(cls)
+
+    def test_TWO_backends_agree( self ):
+        # the same operations on every backend give the same answers
+        s = 'ab${c}${${d}_${e}} $(f) ${g'
+        duts = [cls(s) for cls in BACKENDS]
+        while True:
+            results = [dut.next_macro(0, len(dut)) for dut in duts]
+            found = [(r.code, r.lhs, r.rhs, r.name) for r in results]
+            for f in found:
+                self.assertEqual(f, found[0])
+            for dut in duts:
+                self.assertEqual(str(dut), str(duts[0]))
+                self.assertEqual(dut.iarray(), duts[0].iarray())
+            code, lhs, rhs, name = found[0]
+            if code != results[0].OK:
+                break
+            for dut in duts:
+                if name in ('c', 'e'):
+                    dut.mark(lhs, rhs)
+                else:
+                    dut.replace(lhs, rhs, name.upper())
+        self.assertEqual(str(duts[0]), 'ab${c}D_E $(f) ${g')
+
+    def test_THREE_make_istr( self ):
+        self.assertIsInstance(shellmacros.istr.make_istr('abc'), shellmacros.istr.CompactIStr)
+        # not latin-1
+        dut = shellmacros.istr.make_istr('\u20ac ${a}')
+        if shellmacros.istr.numpy is None:
+            self.assertIsInstance(dut, shellmacros.istr.IStr)
+        else:
+            self.assertIsInstance(dut, shellmacros.istr.NumpyIStr)
+
+    @unittest.skipIf(shellmacros.istr.numpy is None, "requires numpy")
+    def test_FOUR_numpy_unicode( self ):
+        s = '\u20ac ${a} \u0124${b}'
+        dut = shellmacros.istr.NumpyIStr(s)
+        r = dut.next_macro(0, len(dut))
+        self.assertEqual(r.name, 'a')
+        dut.mark(r.lhs, r.rhs)
+        self.assertEqual(str(dut), s)
+        r = dut.next_macro(0, len(dut))
+        self.assertEqual(r.name, 'b')
+        dut.replace(r.lhs, r.rhs, '\u00e9t\u00e9')
+        self.assertEqual(str(dut), '\u20ac ${a} \u0124\u00e9t\u00e9')
+        self.assertEqual(dut.locate(shellmacros.istr.DOLLAR, 0, len(dut)), -1)
+
+    @unittest.skipIf(shellmacros.istr.numpy is None, "requires numpy")
+    def test_FIVE_numpy_non_bmp( self ):
+        # characters above U+FFFF read back as they are, with the flag once marked
+        dut = shellmacros.istr.NumpyIStr('\U0001f600 ${a}')
+        self.assertEqual(dut[0], 0x1f600)
+        self.assertEqual(dut.iarray()[0], 0x1f600)
+        dut.mark(0, 1)
+        self.assertEqual(dut[0], 0x1f600 | dut.IGNORE)
+        self.assertEqual(dut.iarray()[0], 0x1f600 | dut.IGNORE)
+        self.assertEqual(str(dut), '\U0001f600 ${a}')
+        self.assertEqual(dut.next_macro(0, len(dut)).name, 'a')
 
 if __name__ == '__main__':
     unittest.main()